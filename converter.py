@@ -1,21 +1,104 @@
 """
 Converter between Anthropic and OpenAI API formats
 """
-import json
 import time
-import uuid
-from typing import Any, Dict, List, Optional, Union
-from system_prompt_parser import parse_system_prompt, apply_custom_template, apply_prompt_config, load_prompt_config
+import logging
+from secrets import token_hex
+from functools import lru_cache
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Union
+import orjson
+from system_prompt_parser import parse_system_prompt, apply_custom_template
 
+logger = logging.getLogger(__name__)
 
-def apply_custom_system_prompt(system_content: Union[str, List[Dict[str, Any]]], template: str, config_file: Optional[str] = None) -> str:
+
+# OpenAI finish reasons mapped to Anthropic stop reasons
+FINISH_REASON_MAP = {
+    "stop": "end_turn",
+    "length": "max_tokens",
+    "tool_calls": "tool_use",
+    "function_call": "tool_use",
+    "content_filter": "stop_sequence"
+}
+
+# Fields holding user data or JSON schemas, never scanned for cache_control
+OPAQUE_FIELDS = frozenset(("input", "input_schema"))
+
+
+def _dumps(obj: Any) -> str:
+    """Serialize to a compact JSON string using orjson."""
+    return orjson.dumps(obj).decode()
+
+
+# Pre-serialized data lines for stream events that never change
+MESSAGE_STOP_DATA = f"data: {_dumps({'type': 'message_stop'})}"
+CONTENT_BLOCK_STOP_DATA = tuple(
+    f"data: {_dumps({'type': 'content_block_stop', 'index': i})}" for i in range(32)
+)
+
+
+def _content_block_stop_data(index: int) -> str:
+    """Return the content_block_stop data line for a block index."""
+    if index < len(CONTENT_BLOCK_STOP_DATA):
+        return CONTENT_BLOCK_STOP_DATA[index]
+    return f"data: {_dumps({'type': 'content_block_stop', 'index': index})}"
+
+
+def strip_cache_control(data: Any) -> int:
+    """
+    Remove every cache_control key from an Anthropic request in a single pass.
+
+    Walks the request (top level, system blocks, messages, content blocks and
+    tools) in place, without descending into tool inputs or schemas.
+
+    Returns:
+        Number of cache_control keys removed
+    """
+    removed = 0
+    stack = [data]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            if "cache_control" in node:
+                del node["cache_control"]
+                removed += 1
+            for key, value in node.items():
+                if isinstance(value, (dict, list)) and key not in OPAQUE_FIELDS:
+                    stack.append(value)
+        elif isinstance(node, list):
+            for item in node:
+                if isinstance(item, (dict, list)):
+                    stack.append(item)
+    return removed
+
+
+@lru_cache(maxsize=128)
+def _render_system_prompt(system_text: str, template: str, prompt_rewriter: Optional[Callable[[str], str]]) -> str:
+    """Parse, template and rewrite a system prompt; identical prompts repeat on every turn of a session."""
+    # Parse the system prompt to extract dynamic sections
+    sections = parse_system_prompt(system_text)
+    
+    # Apply the custom template
+    modified_prompt = apply_custom_template(template, sections)
+    
+    # Apply configuration-based transformations if a rewriter was provided
+    if prompt_rewriter:
+        try:
+            modified_prompt = prompt_rewriter(modified_prompt)
+        except Exception:
+            logger.exception("Error applying config")
+    
+    return modified_prompt
+
+
+def apply_custom_system_prompt(system_content: Union[str, List[Dict[str, Any]]], template: str, prompt_rewriter: Optional[Callable[[str], str]] = None) -> str:
     """
     Apply a custom system prompt template while preserving dynamic content.
     
     Args:
         system_content: Either a string or list of system message blocks from Anthropic
         template: Custom prompt template with placeholders
-        config_file: Optional path to configuration file
+        prompt_rewriter: Optional rewrite function from build_prompt_rewriter
         
     Returns:
         Modified system prompt as a string
@@ -23,34 +106,17 @@ def apply_custom_system_prompt(system_content: Union[str, List[Dict[str, Any]]],
     # Handle array format (multiple system blocks with cache_control)
     if isinstance(system_content, list):
         # Concatenate all text blocks
-        full_text = ""
-        for block in system_content:
-            if isinstance(block, dict) and block.get("type") == "text":
-                full_text += block["text"] + "\n"
-        system_text = full_text.strip()
+        system_text = "\n".join(
+            block["text"] for block in system_content
+            if isinstance(block, dict) and block.get("type") == "text"
+        )
     else:
         system_text = system_content
     
-    # Parse the system prompt to extract dynamic sections
-    sections = parse_system_prompt(system_text)
-    
-    # Apply the custom template
-    modified_prompt = apply_custom_template(template, sections)
-    
-    # Apply configuration-based transformations if config provided
-    if config_file:
-        try:
-            config = load_prompt_config(config_file)
-            modified_prompt = apply_prompt_config(modified_prompt, config)
-        except Exception as e:
-            print(f"Error applying config: {e}")
-            import traceback
-            traceback.print_exc()
-    
-    return modified_prompt
+    return _render_system_prompt(system_text, template, prompt_rewriter)
 
 
-def convert_anthropic_to_openai(request_data: Dict[str, Any], custom_prompt_template: Optional[str] = None, config_file: Optional[str] = None) -> Dict[str, Any]:
+def convert_anthropic_to_openai(request_data: Dict[str, Any], custom_prompt_template: Optional[str] = None, prompt_rewriter: Optional[Callable[[str], str]] = None) -> Dict[str, Any]:
     """Convert Anthropic request format to OpenAI format"""
     
     # Start with basic fields
@@ -66,13 +132,16 @@ def convert_anthropic_to_openai(request_data: Dict[str, Any], custom_prompt_temp
     if "temperature" in request_data:
         openai_request["temperature"] = request_data["temperature"]
     
+    if "stream" in request_data:
+        openai_request["stream"] = request_data["stream"]
+    
     # Handle system message if present
     if "system" in request_data:
         system_content = request_data["system"]
         
         # Apply custom prompt template if provided
         if custom_prompt_template:
-            system_content = apply_custom_system_prompt(system_content, custom_prompt_template, config_file)
+            system_content = apply_custom_system_prompt(system_content, custom_prompt_template, prompt_rewriter)
         
         openai_request["messages"].append({
             "role": "system",
@@ -80,10 +149,7 @@ def convert_anthropic_to_openai(request_data: Dict[str, Any], custom_prompt_temp
         })
     
     # Convert messages
-    for msg in request_data["messages"]:
-        openai_msg = convert_message_to_openai(msg)
-        if openai_msg:
-            openai_request["messages"].append(openai_msg)
+    openai_request["messages"].extend(convert_messages_to_openai(request_data["messages"]))
     
     # Convert tools
     if "tools" in request_data and request_data["tools"]:
@@ -99,36 +165,60 @@ def convert_anthropic_to_openai(request_data: Dict[str, Any], custom_prompt_temp
             }
             openai_request["tools"].append(openai_tool)
     
-    # Handle tool_choice
+    # tool_choice is never forwarded: xAI rejects Anthropic's tool_choice format
     if "tool_choice" in request_data:
-        openai_request["tool_choice"] = request_data["tool_choice"]
+        logger.debug("Dropping unsupported tool_choice parameter")
     
     return openai_request
 
 
+def convert_messages_to_openai(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Convert a list of Anthropic messages to OpenAI format in a single pass.
+    
+    Plain string messages, the bulk of a conversation, are converted inline;
+    block content and tool messages go through convert_message_to_openai.
+    """
+    openai_messages = []
+    append = openai_messages.append
+    
+    for msg in messages:
+        role = msg["role"]
+        content = msg["content"]
+        if type(content) is str and role != "tool":
+            append({"role": role, "content": content})
+            continue
+        
+        openai_msg = convert_message_to_openai(msg)
+        if openai_msg:
+            append(openai_msg)
+    
+    return openai_messages
+
+
 def convert_message_to_openai(msg: Dict[str, Any]) -> Optional[Dict[str, Any]]:
     """Convert a single Anthropic message to OpenAI format"""
     
     role = msg["role"]
     content = msg["content"]
     
+    # Handle string content first, it is by far the most common case
+    if type(content) is str and role != "tool":
+        return {
+            "role": role,
+            "content": content
+        }
+    
     # Handle tool results (Anthropic) -> tool messages (OpenAI)
     if role == "tool":
         return {
             "role": "tool",
-            "content": json.dumps(content) if not isinstance(content, str) else content,
+            "content": content if type(content) is str else _dumps(content),
             "tool_call_id": msg.get("tool_use_id", "")
         }
     
-    # Handle string content
-    if isinstance(content, str):
-        return {
-            "role": role,
-            "content": content
-        }
-    
     # Handle content blocks
-    if isinstance(content, list):
+    if type(content) is list:
         text_parts = []
         tool_calls = []
         tool_results = []
@@ -142,7 +232,7 @@ def convert_message_to_openai(msg: Dict[str, Any]) -> Optional[Dict[str, Any]]:
                     "type": "function",
                     "function": {
                         "name": block["name"],
-                        "arguments": json.dumps(block["input"])
+                        "arguments": _dumps(block["input"])
                     }
                 }
                 tool_calls.append(tool_call)
@@ -183,7 +273,7 @@ def convert_openai_to_anthropic(response_data: Dict[str, Any], request_id: Optio
     """Convert OpenAI response format to Anthropic format"""
     
     if not request_id:
-        request_id = f"msg_{uuid.uuid4().hex[:12]}"
+        request_id = f"msg_{token_hex(6)}"
     
     # Extract the first choice (Anthropic doesn't support multiple choices)
     choice = response_data["choices"][0]
@@ -206,7 +296,7 @@ def convert_openai_to_anthropic(response_data: Dict[str, Any], request_id: Optio
                 "type": "tool_use",
                 "id": tool_call["id"],
                 "name": tool_call["function"]["name"],
-                "input": json.loads(tool_call["function"]["arguments"])
+                "input": orjson.loads(tool_call["function"]["arguments"])
             })
     
     # Map finish reason
@@ -238,53 +328,107 @@ def convert_openai_to_anthropic(response_data: Dict[str, Any], request_id: Optio
     return anthropic_response
 
 
-def convert_openai_stream_to_anthropic(chunk_line: str, state: Dict[str, Any]) -> List[str]:
+class StreamState:
+    """Progress of a single streamed response, carried across chunks."""
+    
+    __slots__ = (
+        "started",
+        "message_id",
+        "current_tool_calls",
+        "output_tokens",
+        "content_block_started",
+    )
+    
+    def __init__(self) -> None:
+        self.started = False
+        self.message_id = ""
+        self.current_tool_calls = {}
+        self.output_tokens = 0
+        self.content_block_started = False
+
+
+async def aiter_sse_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """
+    Split an async byte stream into lines without decoding it.
+    
+    Lines are yielded as bytes without the trailing newline; a final unterminated
+    line is yielded when the stream ends.
+    """
+    buffer = bytearray()
+    async for chunk in chunks:
+        # What was already buffered holds no newline, so only the new bytes are searched
+        scan = len(buffer)
+        buffer += chunk
+        start = 0
+        while (end := buffer.find(b"\n", scan)) != -1:
+            yield bytes(buffer[start:end])
+            start = scan = end + 1
+        del buffer[:start]
+    if buffer:
+        yield bytes(buffer)
+
+
+async def aiter_sse_line_batches(chunks: AsyncIterator[bytes]) -> AsyncIterator[List[bytes]]:
+    """
+    Like aiter_sse_lines, but yield the complete lines of each network read together,
+    so a caller can answer a whole read with one write.
+    """
+    buffer = bytearray()
+    async for chunk in chunks:
+        # What was already buffered holds no newline, so only the new bytes are searched
+        scan = len(buffer)
+        buffer += chunk
+        end = buffer.rfind(b"\n", scan)
+        if end != -1:
+            lines = bytes(buffer[:end]).split(b"\n")
+            del buffer[:end + 1]
+            yield lines
+    if buffer:
+        yield [bytes(buffer)]
+
+
+def convert_openai_stream_to_anthropic(chunk_line: Union[str, bytes], state: StreamState) -> List[str]:
     """
     Convert a single OpenAI streaming chunk to Anthropic SSE format.
     
     Args:
-        chunk_line: A line from OpenAI SSE stream (e.g., "data: {...}")
-        state: Mutable state dict to track message progress
+        chunk_line: A line from OpenAI SSE stream (e.g., "data: {...}"), as str or undecoded bytes
+        state: Mutable StreamState tracking message progress
         
     Returns:
         List of Anthropic SSE formatted lines to send
     """
-    events = []
+    prefix, done = (b"data: ", b"[DONE]") if isinstance(chunk_line, bytes) else ("data: ", "[DONE]")
+    
+    # Only data lines carry events; this also skips empty lines and SSE comments
+    if not chunk_line.startswith(prefix):
+        return []
+    
+    payload = chunk_line[6:].strip()  # Skip "data: " prefix
     
-    # Skip empty lines
-    if not chunk_line.strip():
-        return events
-        
     # Handle the [DONE] message
-    if chunk_line.strip() == "data: [DONE]":
+    if payload == done:
         # Send message_stop event
-        events.append("event: message_stop")
-        events.append(f"data: {json.dumps({'type': 'message_stop'})}")
-        return events
+        return ["event: message_stop", MESSAGE_STOP_DATA]
     
     # Parse the JSON data
-    if not chunk_line.startswith("data: "):
-        return events
-        
     try:
-        chunk_data = json.loads(chunk_line[6:])  # Skip "data: " prefix
-    except json.JSONDecodeError:
-        return events
+        chunk_data = orjson.loads(payload)
+    except orjson.JSONDecodeError:
+        return []
+    
+    events = []
     
     # Initialize state if needed
-    if not state.get('started'):
-        state['started'] = True
-        state['message_id'] = f"msg_{uuid.uuid4().hex[:12]}"
-        state['content_blocks'] = []
-        state['current_tool_calls'] = {}
-        state['input_tokens'] = 0
-        state['output_tokens'] = 0
+    if not state.started:
+        state.started = True
+        state.message_id = f"msg_{token_hex(6)}"
         
         # Send message_start event
         message_start = {
             "type": "message_start",
             "message": {
-                "id": state['message_id'],
+                "id": state.message_id,
                 "type": "message",
                 "role": "assistant",
                 "content": [],
@@ -296,18 +440,23 @@ def convert_openai_stream_to_anthropic(chunk_line: str, state: Dict[str, Any]) -
             }
         }
         events.append("event: message_start")
-        events.append(f"data: {json.dumps(message_start)}")
+        events.append(f"data: {_dumps(message_start)}")
     
     # Process choices
-    if "choices" in chunk_data and chunk_data["choices"]:
-        choice = chunk_data["choices"][0]
-        delta = choice.get("delta", {})
+    choices = chunk_data.get("choices")
+    if choices:
+        choice = choices[0]
+        try:
+            delta = choice["delta"]
+        except KeyError:
+            delta = {}
         
         # Handle content
-        if "content" in delta and delta["content"]:
+        text = delta.get("content")
+        if text:
             # Initialize content block if needed
-            if not state.get('content_block_started'):
-                state['content_block_started'] = True
+            if not state.content_block_started:
+                state.content_block_started = True
                 content_block_start = {
                     "type": "content_block_start",
                     "index": 0,
@@ -317,7 +466,7 @@ def convert_openai_stream_to_anthropic(chunk_line: str, state: Dict[str, Any]) -
                     }
                 }
                 events.append("event: content_block_start")
-                events.append(f"data: {json.dumps(content_block_start)}")
+                events.append(f"data: {_dumps(content_block_start)}")
             
             # Send content delta
             content_delta = {
@@ -325,23 +474,26 @@ def convert_openai_stream_to_anthropic(chunk_line: str, state: Dict[str, Any]) -
                 "index": 0,
                 "delta": {
                     "type": "text_delta",
-                    "text": delta["content"]
+                    "text": text
                 }
             }
             events.append("event: content_block_delta")
-            events.append(f"data: {json.dumps(content_delta)}")
+            events.append(f"data: {_dumps(content_delta)}")
         
         # Handle tool calls
-        if "tool_calls" in delta:
-            for tool_call in delta["tool_calls"]:
+        tool_calls = delta.get("tool_calls")
+        if tool_calls:
+            current_tool_calls = state.current_tool_calls
+            for tool_call in tool_calls:
                 tool_index = tool_call["index"]
+                tool_state = current_tool_calls.get(tool_index)
                 
                 # Initialize tool call if new
-                if tool_index not in state['current_tool_calls']:
-                    state['current_tool_calls'][tool_index] = {
-                        "id": tool_call.get("id", ""),
-                        "name": "",
-                        "arguments": ""
+                if tool_state is None:
+                    tool_id = tool_call.get("id", "")
+                    tool_state = current_tool_calls[tool_index] = {
+                        "id": tool_id,
+                        "name": ""
                     }
                     
                     # Send content_block_start for tool
@@ -350,96 +502,68 @@ def convert_openai_stream_to_anthropic(chunk_line: str, state: Dict[str, Any]) -
                         "index": tool_index + 1,  # +1 because text content is index 0
                         "content_block": {
                             "type": "tool_use",
-                            "id": tool_call.get("id", ""),
+                            "id": tool_id,
                             "name": "",
                             "input": {}
                         }
                     }
                     events.append("event: content_block_start")
-                    events.append(f"data: {json.dumps(tool_block_start)}")
+                    events.append(f"data: {_dumps(tool_block_start)}")
                 
                 # Update tool call data
-                if "function" in tool_call:
-                    if "name" in tool_call["function"]:
-                        state['current_tool_calls'][tool_index]["name"] = tool_call["function"]["name"]
-                    if "arguments" in tool_call["function"]:
-                        state['current_tool_calls'][tool_index]["arguments"] += tool_call["function"]["arguments"]
-                        
-                        # Try to parse arguments as we receive them
-                        try:
-                            args_json = json.loads(state['current_tool_calls'][tool_index]["arguments"])
-                            tool_delta = {
-                                "type": "content_block_delta",
-                                "index": tool_index + 1,
-                                "delta": {
-                                    "type": "input_json_delta",
-                                    "partial_json": json.dumps(args_json)
-                                }
+                function = tool_call.get("function")
+                if function:
+                    if "name" in function:
+                        tool_state["name"] = function["name"]
+                    fragment = function.get("arguments")
+                    if fragment:
+                        # Forward the fragment as-is; clients concatenate partial_json deltas
+                        tool_delta = {
+                            "type": "content_block_delta",
+                            "index": tool_index + 1,
+                            "delta": {
+                                "type": "input_json_delta",
+                                "partial_json": fragment
                             }
-                            events.append("event: content_block_delta")
-                            events.append(f"data: {json.dumps(tool_delta)}")
-                        except json.JSONDecodeError:
-                            # Arguments not complete yet, send partial
-                            tool_delta = {
-                                "type": "content_block_delta",
-                                "index": tool_index + 1,
-                                "delta": {
-                                    "type": "input_json_delta",
-                                    "partial_json": tool_call["function"]["arguments"]
-                                }
-                            }
-                            events.append("event: content_block_delta")
-                            events.append(f"data: {json.dumps(tool_delta)}")
+                        }
+                        events.append("event: content_block_delta")
+                        events.append(f"data: {_dumps(tool_delta)}")
         
         # Handle finish reason
-        if "finish_reason" in choice and choice["finish_reason"]:
+        finish_reason = choice.get("finish_reason")
+        if finish_reason:
             # Send content_block_stop for any open blocks
-            if state.get('content_block_started'):
-                content_block_stop = {
-                    "type": "content_block_stop",
-                    "index": 0
-                }
+            if state.content_block_started:
                 events.append("event: content_block_stop")
-                events.append(f"data: {json.dumps(content_block_stop)}")
+                events.append(CONTENT_BLOCK_STOP_DATA[0])
             
             # Send content_block_stop for each tool
-            for tool_index in state['current_tool_calls']:
-                tool_block_stop = {
-                    "type": "content_block_stop",
-                    "index": tool_index + 1
-                }
+            for tool_index in state.current_tool_calls:
                 events.append("event: content_block_stop")
-                events.append(f"data: {json.dumps(tool_block_stop)}")
+                events.append(_content_block_stop_data(tool_index + 1))
             
             # Send message_delta with stop_reason
             message_delta = {
                 "type": "message_delta",
                 "delta": {
-                    "stop_reason": map_openai_finish_reason(choice["finish_reason"]),
+                    "stop_reason": map_openai_finish_reason(finish_reason),
                     "stop_sequence": None
                 },
                 "usage": {
-                    "output_tokens": state.get('output_tokens', 0)
+                    "output_tokens": state.output_tokens
                 }
             }
             events.append("event: message_delta")
-            events.append(f"data: {json.dumps(message_delta)}")
+            events.append(f"data: {_dumps(message_delta)}")
     
     # Track usage if provided
-    if "usage" in chunk_data:
-        state['input_tokens'] = chunk_data["usage"].get("prompt_tokens", 0)
-        state['output_tokens'] = chunk_data["usage"].get("completion_tokens", 0)
+    usage = chunk_data.get("usage")
+    if usage:
+        state.output_tokens = usage.get("completion_tokens", 0)
     
     return events
 
 
 def map_openai_finish_reason(openai_reason: str) -> str:
     """Map OpenAI finish reasons to Anthropic stop reasons."""
-    mapping = {
-        "stop": "end_turn",
-        "length": "max_tokens",
-        "tool_calls": "tool_use",
-        "function_call": "tool_use",
-        "content_filter": "stop_sequence"
-    }
-    return mapping.get(openai_reason, "end_turn")
\ No newline at end of file
+    return FINISH_REASON_MAP.get(openai_reason, "end_turn")
\ No newline at end of file
@@ -1,21 +1,28 @@
 import os
+import re
 import json
+import fcntl
+import hashlib
 import logging
-from datetime import datetime
-from flask import Flask, request, Response
+import secrets
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from pathlib import Path
+from flask import Flask, request, Response, send_file
+from cachetools import TTLCache
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from converter import strip_cache_control
+from log_writer import setup_queue_logging
 
 app = Flask(__name__)
+app.debug = False
 
-# Set up logging to file
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('grok_proxy.log'),
-        logging.StreamHandler()  # Also log to console
-    ]
-)
+# Set up logging to file and console, written by a background listener thread
+setup_queue_logging('grok_proxy.log', console=True)
 
 # Load xAI API key from environment (set this before running)
 XAI_API_KEY = os.environ.get('XAI_API_KEY')
@@ -24,143 +31,164 @@ if not XAI_API_KEY:
 
 XAI_BASE_URL = 'https://api.x.ai/v1'
 
-@app.route('/v1/messages', methods=['POST'])
-def proxy_messages():
-    data = request.json
-    
-    # Log request details
-    logging.info("="*80)
-    logging.info("NEW REQUEST")
-    logging.info("="*80)
-    
-    # Log headers
-    logging.info("Request Headers:")
-    for header, value in request.headers:
-        logging.info(f"  {header}: {value}")
-    
-    # Log original model
-    original_model = data.get('model', 'not specified')
-    logging.info(f"\nOriginal Model: {original_model}")
-    
-    # Log messages/prompt
-    messages = data.get('messages', [])
-    logging.info(f"\nMessages ({len(messages)} total):")
-    for i, msg in enumerate(messages):
-        role = msg.get('role', 'unknown')
-        content = msg.get('content', '')
-        # Truncate very long content for logging
-        if len(content) > 500:
-            content = content[:500] + "... [truncated]"
-        logging.info(f"  [{i}] {role}: {content}")
-    
-    # Log other parameters
-    logging.info(f"\nOther parameters:")
-    for key, value in data.items():
-        if key not in ['model', 'messages']:
-            logging.info(f"  {key}: {value}")
-
-    # Remove unsupported params (add more if you encounter others)
-    if 'cache_control' in data:
-        logging.info("\nRemoving unsupported parameter: cache_control")
-        del data['cache_control']
-    
-    # Also remove cache_control from messages if present
-    messages = data.get('messages', [])
-    for msg in messages:
-        if isinstance(msg, dict) and 'cache_control' in msg:
-            logging.info(f"\nRemoving cache_control from message with role: {msg.get('role', 'unknown')}")
-            del msg['cache_control']
-        
-        # Handle tool result messages - convert to format xAI understands
-        if msg.get('role') == 'tool':
-            logging.info(f"\n🔧 Converting tool result message with id: {msg.get('tool_use_id', 'unknown')}")
-            # Keep the tool message as-is - xAI supports Anthropic format
-            
-        # Handle content if it's a list of objects
-        content = msg.get('content', [])
-        if isinstance(content, list):
-            for item in content:
-                if isinstance(item, dict) and 'cache_control' in item:
-                    logging.info(f"\nRemoving cache_control from content item")
-                    del item['cache_control']
-    
-    # Also check system messages
-    system = data.get('system', [])
-    if isinstance(system, list):
-        for item in system:
-            if isinstance(item, dict) and 'cache_control' in item:
-                logging.info(f"\nRemoving cache_control from system message")
-                del item['cache_control']
+# Shared session so TCP/TLS connections to xAI are kept alive and reused across requests
+SESSION = requests.Session()
+SESSION.headers.update({
+    'Authorization': f'Bearer {XAI_API_KEY}',
+    'Content-Type': 'application/json'
+})
+SESSION.mount('https://', HTTPAdapter(pool_connections=64, pool_maxsize=64))
+
+# Optional exact-match cache for non-streaming responses (disabled unless RESPONSE_CACHE_TTL > 0)
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', '0'))
+response_cache = TTLCache(maxsize=10_000, ttl=RESPONSE_CACHE_TTL) if RESPONSE_CACHE_TTL > 0 else None
+response_cache_lock = threading.Lock()
+
+# Message batches are fanned out to xAI with bounded concurrency; status and results
+# are persisted under BATCH_DIR so every worker process can serve them
+BATCH_DIR = Path(os.environ.get('BATCH_DIR', 'batches'))
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', '16'))
+BATCH_MAX_REQUESTS = 10_000
+BATCH_STATUS_INTERVAL = 100  # Rewrite the status file every N completed requests
+BATCH_ID_RE = re.compile(r'msgbatch_[0-9a-f]{24}')
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY, thread_name_prefix='batch')
+
+# Tools with known compatibility issues with xAI
+SKIP_TOOLS = frozenset(('Glob', 'Grep'))
+
+# JSON schema fields that might cause issues with xAI
+BAD_SCHEMA_KEYS = frozenset(('$schema', 'additionalProperties'))
+
+# Property names that make xAI reject a tool schema ('description' verified to cause errors)
+RESERVED_PROP_NAMES = frozenset(('description',))
+
+def _filter_tools(tools):
+    """Return the tools xAI accepts, with unsupported schema keys dropped."""
+    safe_tools = []
+    for tool in tools:
+        schema = tool.get('input_schema') if isinstance(tool, dict) else None
+        if schema is None:
+            # Keep tools without input_schema
+            safe_tools.append(tool)
+            continue
+
+        # Skip known problematic tools
+        tool_name = tool.get('name', '')
+        if tool_name in SKIP_TOOLS:
+            logging.info(f"⚠️  Skipping tool '{tool_name}' - known compatibility issues with xAI")
+            continue
+
+        # Check for problematic property names
+        props = schema.get('properties')
+        if props and not RESERVED_PROP_NAMES.isdisjoint(props):
+            logging.info(f"⚠️  Skipping tool '{tool_name}' - has a reserved property name which causes xAI errors")
+            continue
+
+        # Rebuild the schema without fields that might cause issues
+        schema = {k: v for k, v in schema.items() if k not in BAD_SCHEMA_KEYS}
+        safe_tools.append({**tool, 'input_schema': schema})
+    return safe_tools
+
+def _prepare_request(data, original_model, log_info):
+    """Rewrite an Anthropic request in place into the form xAI accepts."""
+    # Remove unsupported cache_control params from the request, messages, content and system blocks
+    removed = strip_cache_control(data)
+    if removed and log_info:
+        logging.info(f"\nRemoved {removed} unsupported cache_control parameter(s)")
     
     # xAI expects Anthropic format! Filter out problematic tools
     if 'tools' in data:
         original_tools = data['tools']
-        safe_tools = []
-        
-        for tool in original_tools:
-            if isinstance(tool, dict) and 'input_schema' in tool:
-                schema = tool['input_schema']
-                
-                # Remove fields that might cause issues
-                if '$schema' in schema:
-                    del schema['$schema']
-                if 'additionalProperties' in schema:
-                    del schema['additionalProperties']
-                
-                # Check for problematic property names or known problematic tools
-                skip_tool = False
-                tool_name = tool.get('name', '')
-                
-                # Skip known problematic tools
-                if tool_name in ['Glob', 'Grep']:
-                    logging.info(f"⚠️  Skipping tool '{tool_name}' - known compatibility issues with xAI")
-                    skip_tool = True
-                elif 'properties' in schema:
-                    props = schema['properties']
-                    # Only skip tools with 'description' as property name (verified to cause errors)
-                    if 'description' in props:
-                        logging.info(f"⚠️  Skipping tool '{tool_name}' - has 'description' property which causes xAI errors")
-                        skip_tool = True
-                
-                if not skip_tool:
-                    safe_tools.append(tool)
-            else:
-                # Keep tools without input_schema
-                safe_tools.append(tool)
-        
+        safe_tools = _filter_tools(original_tools)
         data['tools'] = safe_tools
-        logging.info(f"\n✅ Filtered from {len(original_tools)} to {len(safe_tools)} safe tools")
-        
         # Log accepted tools for debugging
-        for i, tool in enumerate(safe_tools[:5]):
-            logging.info(f"  Accepted Tool {i}: {tool.get('name', 'unnamed')}")
+        if log_info:
+            parts = [f"\n✅ Filtered from {len(original_tools)} to {len(safe_tools)} safe tools"]
+            for i, tool in enumerate(safe_tools[:5]):
+                parts.append(f"  Accepted Tool {i}: {tool.get('name', 'unnamed')}")
+            logging.info("\n".join(parts))
     
     # Remove tool_choice - it's causing format issues with xAI
     if 'tool_choice' in data:
-        logging.info("\nRemoving tool_choice parameter")
         del data['tool_choice']
+        if log_info:
+            logging.info("\nRemoving tool_choice parameter")
 
     # Always map to grok-4 regardless of input model
     data['model'] = 'grok-4'
-    logging.info(f"\nMapped model: {original_model} -> grok-4")
+    if log_info:
+        logging.info(f"\nMapped model: {original_model} -> grok-4")
 
-    # Prepare headers with xAI auth
-    headers = {
-        'Authorization': f'Bearer {XAI_API_KEY}',
-        'Content-Type': 'application/json'
-    }
+@app.route('/v1/messages', methods=['POST'])
+def proxy_messages():
+    try:
+        data = orjson.loads(request.get_data())
+    except orjson.JSONDecodeError as e:
+        return _error_response(f"Request body is not valid JSON: {e}")
+    if not isinstance(data, dict):
+        return _error_response("Request body must be a JSON object")
+    
+    original_model = data.get('model', 'not specified')
+    log_info = logging.getLogger().isEnabledFor(logging.INFO)
+
+    # Log request details as a single record, and only build it if INFO is enabled
+    if log_info:
+        parts = ["="*80, "NEW REQUEST", "="*80]
+
+        # Log headers
+        parts.append("Request Headers:")
+        for header, value in request.headers:
+            parts.append(f"  {header}: {value}")
+
+        # Log original model
+        parts.append(f"\nOriginal Model: {original_model}")
+
+        # Log messages/prompt
+        messages = data.get('messages', [])
+        parts.append(f"\nMessages ({len(messages)} total):")
+        for i, msg in enumerate(messages):
+            role = msg.get('role', 'unknown')
+            content = msg.get('content', '')
+            # Truncate very long content for logging
+            if len(content) > 500:
+                content = content[:500] + "... [truncated]"
+            parts.append(f"  [{i}] {role}: {content}")
+
+        # Log other parameters
+        parts.append("\nOther parameters:")
+        for key, value in data.items():
+            if key not in ['model', 'messages']:
+                parts.append(f"  {key}: {value}")
+
+        logging.info("\n".join(parts))
+
+    _prepare_request(data, original_model, log_info)
 
     # Forward the request to xAI (supports streaming)
     stream = data.get('stream', False)
-    logging.info(f"\nForwarding to xAI API: {XAI_BASE_URL}/messages")
-    logging.info(f"Streaming: {stream}")
+
+    # Serve identical non-streaming requests from the response cache
+    cache_key = None
+    if response_cache is not None and not stream:
+        payload = orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+        cache_key = hashlib.blake2b(payload, digest_size=16).digest()
+        with response_cache_lock:
+            cached = response_cache.get(cache_key)
+        if cached is not None:
+            logging.info("\nReturning cached response")
+            body, content_type = cached
+            return Response(body, content_type=content_type, status=200)
+    else:
+        payload = orjson.dumps(data)
+
+    logging.info(f"\nForwarding to xAI API: {XAI_BASE_URL}/messages\nStreaming: {stream}")
     
     try:
-        response = requests.post(
+        # Always stream from upstream so the non-streaming body can be passed through unread
+        response = SESSION.post(
             f'{XAI_BASE_URL}/messages',
-            json=data,
-            headers=headers,
-            stream=stream
+            data=payload,
+            stream=True
         )
         
         logging.info(f"\nResponse Status: {response.status_code}")
@@ -169,28 +197,242 @@ def proxy_messages():
         if stream:
             logging.info("Returning streaming response")
             def generate():
-                for chunk in response.iter_content(chunk_size=1024):
-                    if chunk:
-                        yield chunk
+                # Split on the SSE event separator so every yield is a complete frame
+                for frame in response.iter_lines(delimiter=b"\n\n"):
+                    if frame:
+                        yield frame + b"\n\n"
             return Response(generate(), content_type=response.headers.get('Content-Type'), status=response.status_code)
 
         # Non-streaming: Return JSON
         logging.info("Returning non-streaming response")
-        # Log response content (truncated if too long)
-        try:
-            response_text = response.text
-            if len(response_text) > 1000:
-                response_text = response_text[:1000] + "... [truncated]"
-            logging.info(f"Response content: {response_text}")
-        except:
-            logging.info("Could not log response content")
-            
-        return Response(response.content, content_type=response.headers.get('Content-Type'), status=response.status_code)
+        log_debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        if cache_key is None and not log_debug:
+            # Nothing here needs the body, so hand the upstream bytes to the WSGI server as they arrive
+            def passthrough():
+                try:
+                    yield from response.iter_content(chunk_size=65536)
+                finally:
+                    response.close()
+            return Response(
+                passthrough(),
+                content_type=response.headers.get('Content-Type'),
+                status=response.status_code,
+                direct_passthrough=True
+            )
+
+        body = response.content
+        # Log response content (truncated if too long) without decoding the whole body
+        if log_debug:
+            preview = body[:1000].decode('utf-8', errors='replace')
+            if len(body) > 1000:
+                preview += "... [truncated]"
+            logging.debug(f"Response content: {preview}")
+
+        if cache_key is not None and response.status_code == 200:
+            with response_cache_lock:
+                response_cache[cache_key] = (body, response.headers.get('Content-Type'))
+
+        return Response(body, content_type=response.headers.get('Content-Type'), status=response.status_code)
         
     except Exception as e:
         logging.error(f"Error forwarding request: {str(e)}")
         raise
 
+def _error_response(message, status=400, error_type='invalid_request_error'):
+    """Build an Anthropic-style error response."""
+    return Response(
+        orjson.dumps({"type": "error", "error": {"type": error_type, "message": message}}),
+        status=status,
+        content_type='application/json'
+    )
+
+def _batch_path(batch_id, suffix):
+    return BATCH_DIR / f"{batch_id}{suffix}"
+
+def _write_batch_status(batch):
+    # Write to a temp file and rename so readers never see a partial status
+    path = _batch_path(batch['id'], '.json')
+    tmp_path = path.with_suffix('.json.tmp')
+    tmp_path.write_bytes(orjson.dumps(batch))
+    os.replace(tmp_path, path)
+
+def _parse_batch_requests(body):
+    """Accept {"requests": [...]} JSON or one {"custom_id", "params"} object per JSONL line."""
+    try:
+        parsed = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        return [orjson.loads(line) for line in body.splitlines() if line.strip()]
+    if isinstance(parsed, dict):
+        return parsed['requests'] if 'requests' in parsed else [parsed]
+    return parsed
+
+def _send_batch_request(params):
+    """Forward one batch request to xAI and return its batch result object."""
+    try:
+        response = SESSION.post(f'{XAI_BASE_URL}/messages', data=orjson.dumps(params))
+        body = orjson.loads(response.content)
+    except Exception as e:
+        return {"type": "errored", "error": {"type": "api_error", "message": str(e)}}
+    if response.status_code == 200:
+        return {"type": "succeeded", "message": body}
+    error = body.get('error', body) if isinstance(body, dict) else body
+    return {"type": "errored", "error": error}
+
+def _end_batch(batch, results_url):
+    """Mark a batch ended; requests that never finished count as errored."""
+    counts = batch['request_counts']
+    counts['errored'] += counts['processing']
+    counts['processing'] = 0
+    batch['processing_status'] = 'ended'
+    batch['ended_at'] = datetime.now(timezone.utc).isoformat()
+    batch['results_url'] = results_url
+
+def _run_batch(batch, items, results, results_url):
+    """Send a batch's requests and append their results to the (locked) results file."""
+    counts = batch['request_counts']
+    futures = {}
+    try:
+        futures = {
+            batch_executor.submit(_send_batch_request, item['params']): item['custom_id']
+            for item in items
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            result = future.result()
+            counts['processing'] -= 1
+            counts[result['type']] += 1
+            results.write(orjson.dumps({"custom_id": futures[future], "result": result}) + b"\n")
+            if done % BATCH_STATUS_INTERVAL == 0:
+                _write_batch_status(batch)
+    except Exception:
+        logging.exception(f"Batch {batch['id']} failed; its unfinished requests are counted as errored")
+        for future in futures:
+            future.cancel()
+    finally:
+        # Always leave a final status; the results file stays locked until it is written
+        _end_batch(batch, results_url)
+        try:
+            _write_batch_status(batch)
+        except Exception:
+            logging.exception(f"Failed to write the final status of batch {batch['id']}")
+        results.close()
+    logging.info(f"Batch {batch['id']} ended: {counts['succeeded']} succeeded, {counts['errored']} errored")
+
+def _recover_batches():
+    """
+    End batches left in_progress by a process that died mid-batch.
+    A running batch holds an flock on its results file, so batches still running
+    in another worker are skipped. Counts are rebuilt from the results written so far.
+    """
+    if not BATCH_DIR.is_dir():
+        return
+    for path in BATCH_DIR.glob('msgbatch_*.json'):
+        try:
+            batch = orjson.loads(path.read_bytes())
+            if batch.get('processing_status') != 'in_progress':
+                continue
+            with open(_batch_path(batch['id'], '.jsonl'), 'ab+') as results:
+                try:
+                    fcntl.flock(results, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                results.seek(0)
+                finished = Counter()
+                for line in results:
+                    try:
+                        finished[orjson.loads(line)['result']['type']] += 1
+                    except (orjson.JSONDecodeError, KeyError, TypeError):
+                        pass  # A line cut short by the crash
+                counts = batch['request_counts']
+                total = sum(counts.values())
+                counts.update(
+                    processing=total - finished['succeeded'] - finished['errored'],
+                    succeeded=finished['succeeded'],
+                    errored=finished['errored']
+                )
+                _end_batch(batch, f"/v1/messages/batches/{batch['id']}/results")
+                _write_batch_status(batch)
+            logging.warning(f"Batch {batch['id']} was interrupted; marked ended with {counts['errored']} errored")
+        except Exception:
+            logging.exception(f"Failed to recover batch status {path}")
+
+_recover_batches()
+
+@app.route('/v1/messages/batches', methods=['POST'])
+def create_message_batch():
+    try:
+        items = _parse_batch_requests(request.get_data())
+    except orjson.JSONDecodeError as e:
+        return _error_response(f"Invalid batch body: {e}")
+
+    if not isinstance(items, list) or not 0 < len(items) <= BATCH_MAX_REQUESTS:
+        return _error_response(f"A batch must contain between 1 and {BATCH_MAX_REQUESTS} requests")
+
+    seen_ids = set()
+    for item in items:
+        custom_id = item.get('custom_id') if isinstance(item, dict) else None
+        if not isinstance(custom_id, str) or not isinstance(item.get('params'), dict):
+            return _error_response("Each batch request needs a string custom_id and a params object")
+        if custom_id in seen_ids:
+            return _error_response(f"Duplicate custom_id: {custom_id}")
+        seen_ids.add(custom_id)
+
+    # Batched requests are never streamed
+    for item in items:
+        params = item['params']
+        params.pop('stream', None)
+        _prepare_request(params, params.get('model', 'not specified'), False)
+
+    batch_id = f"msgbatch_{secrets.token_hex(12)}"
+    batch = {
+        "id": batch_id,
+        "type": "message_batch",
+        "processing_status": "in_progress",
+        "request_counts": {
+            "processing": len(items),
+            "succeeded": 0,
+            "errored": 0,
+            "canceled": 0,
+            "expired": 0
+        },
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "ended_at": None,
+        "results_url": None
+    }
+    BATCH_DIR.mkdir(parents=True, exist_ok=True)
+    # The lock marks the batch as running for _recover_batches in other workers; it is
+    # taken before the status exists and released when the process exits or the batch ends
+    results = open(_batch_path(batch_id, '.jsonl'), 'wb')
+    fcntl.flock(results, fcntl.LOCK_EX)
+    try:
+        _write_batch_status(batch)
+    except Exception:
+        results.close()
+        raise
+
+    results_url = f"{request.host_url}v1/messages/batches/{batch_id}/results"
+    threading.Thread(target=_run_batch, args=(batch, items, results, results_url), daemon=True).start()
+    logging.info(f"Created batch {batch_id} with {len(items)} requests")
+
+    return Response(orjson.dumps(batch), content_type='application/json', status=200)
+
+@app.route('/v1/messages/batches/<batch_id>', methods=['GET'])
+def get_message_batch(batch_id):
+    path = _batch_path(batch_id, '.json')
+    if not BATCH_ID_RE.fullmatch(batch_id) or not path.exists():
+        return _error_response(f"Batch not found: {batch_id}", 404, 'not_found_error')
+    return Response(path.read_bytes(), content_type='application/json', status=200)
+
+@app.route('/v1/messages/batches/<batch_id>/results', methods=['GET'])
+def get_message_batch_results(batch_id):
+    path = _batch_path(batch_id, '.json')
+    if not BATCH_ID_RE.fullmatch(batch_id) or not path.exists():
+        return _error_response(f"Batch not found: {batch_id}", 404, 'not_found_error')
+    if orjson.loads(path.read_bytes())['processing_status'] != 'ended':
+        return _error_response(f"Batch {batch_id} is still in progress")
+    return send_file(_batch_path(batch_id, '.jsonl').resolve(), mimetype='application/x-jsonl')
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8000, debug=True)  # Debug mode for testing; remove for production
+    # Local development only; in production run under gunicorn, e.g.
+    #   gunicorn -w $(nproc) -k gevent --worker-connections 1000 -b 0.0.0.0:8000 grok_proxy:app
+    app.run(host='0.0.0.0', port=8000, threaded=True)
 
@@ -1,23 +1,21 @@
 import os
-import json
+import time
 import logging
+import itertools
 from datetime import datetime
 from pathlib import Path
-from flask import Flask, request, Response
-import requests
-from converter import convert_anthropic_to_openai, convert_openai_to_anthropic, convert_openai_stream_to_anthropic
+from fastapi import FastAPI, Request
+from fastapi.responses import Response, StreamingResponse
+import httpx
+import orjson
+import uvicorn
+from proxy_common import client_lifespan, invalid_request
+from log_writer import LogJob, LogWriter, setup_queue_logging
+from system_prompt_parser import build_prompt_rewriter, load_prompt_config
+from converter import StreamState, aiter_sse_lines, strip_cache_control, convert_anthropic_to_openai, convert_openai_to_anthropic, convert_openai_stream_to_anthropic
 
-app = Flask(__name__)
-
-# Set up logging to file
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('grok_proxy_openai.log'),
-        logging.StreamHandler()  # Also log to console
-    ]
-)
+# Set up logging to file and console, written by a background listener thread
+setup_queue_logging('grok_proxy_openai.log', console=True)
 
 # Load xAI API key from environment (set this before running)
 XAI_API_KEY = os.environ.get('XAI_API_KEY')
@@ -26,151 +24,152 @@ if not XAI_API_KEY:
 
 XAI_BASE_URL = 'https://api.x.ai/v1'
 
+BANNER = "=" * 80
+
+# Number of uvicorn worker processes when run as a script
+WORKERS = int(os.environ.get('WORKERS', '1'))
+
+# Makes request ids unique within the process even when two share a timestamp
+REQUEST_COUNTER = itertools.count()
+
+# Shared async client: pooled, kept-alive HTTP/2 connections to xAI, multiplexed on the event loop.
+# The transport retries failed connection attempts only; a sent request is never replayed.
+client = httpx.AsyncClient(
+    base_url=XAI_BASE_URL,
+    headers={'Authorization': f'Bearer {XAI_API_KEY}', 'Content-Type': 'application/json'},
+    timeout=httpx.Timeout(600, connect=10),
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=2,
+        limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100, keepalive_expiry=60)
+    )
+)
+
+app = FastAPI(lifespan=client_lifespan(client))
+
 # Enable full logging
 ENABLE_FULL_LOGGING = os.environ.get('ENABLE_FULL_LOGGING', 'true').lower() == 'true'
 LOG_DIR = Path(os.environ.get('LOG_DIR', 'logs/requests'))
+STREAM_LOG_CHUNK = 1 << 16  # Bytes of streamed response buffered before each log append
+COMPRESS_LOGS = os.environ.get('COMPRESS_LOGS', 'true').lower() == 'true'  # zstd-compress log files
 
 # Enable custom system prompt
 USE_CUSTOM_PROMPT = os.environ.get('USE_CUSTOM_PROMPT', 'false').lower() == 'true'
 CUSTOM_PROMPT_FILE = os.environ.get('CUSTOM_PROMPT_FILE', 'system_prompt_template_unrestricted.txt')
 PROMPT_CONFIG_FILE = os.environ.get('PROMPT_CONFIG_FILE', 'prompt_config.json')
 
-# Load custom prompt template if enabled
+# Load custom prompt template and configuration once if enabled; the config is
+# compiled into a rewrite function that only runs the rules it enables
 custom_prompt_template = None
+prompt_rewriter = None
 if USE_CUSTOM_PROMPT:
     try:
         with open(CUSTOM_PROMPT_FILE, 'r') as f:
             custom_prompt_template = f.read()
-        logging.info(f"Custom system prompt enabled. Loaded template from: {CUSTOM_PROMPT_FILE}")
+        logging.info("Custom system prompt enabled. Loaded template from: %s", CUSTOM_PROMPT_FILE)
         
         # Check if config file exists
         if os.path.exists(PROMPT_CONFIG_FILE):
-            logging.info(f"Using prompt configuration from: {PROMPT_CONFIG_FILE}")
+            prompt_rewriter = build_prompt_rewriter(load_prompt_config(PROMPT_CONFIG_FILE))
+            logging.info("Using prompt configuration from: %s", PROMPT_CONFIG_FILE)
     except Exception as e:
-        logging.error(f"Failed to load custom prompt template: {e}")
+        logging.error("Failed to load custom prompt template: %s", e)
         USE_CUSTOM_PROMPT = False
 
-# Create log directory structure
+# Create log directory structure; log files are written off the request path by a background thread
+log_writer = None
 if ENABLE_FULL_LOGGING:
     LOG_DIR.mkdir(parents=True, exist_ok=True)
-    logging.info(f"Full logging enabled. Logs will be saved to: {LOG_DIR}")
+    log_writer = LogWriter(compress=COMPRESS_LOGS)
+    logging.info("Full logging enabled. Logs will be saved to: %s", LOG_DIR)
+
+def _metadata_payload(request_id, start_ns, duration_ns, **fields):
+    """Metadata for the log writer; it calls the returned function, so timestamps are formatted off the request path"""
+    def build():
+        return {
+            "request_id": request_id,
+            "start_time": datetime.fromtimestamp(start_ns / 1e9).isoformat(),
+            "end_time": datetime.fromtimestamp((start_ns + duration_ns) / 1e9).isoformat(),
+            "duration_ms": duration_ns / 1e6,
+            **fields
+        }
+    return build
 
 def save_request_response_logs(request_id, anthropic_request, openai_request, 
                                openai_response, anthropic_response, metadata, 
-                               is_streaming=False, stream_content=None):
-    """Save full request/response data for analysis"""
+                               start_ns):
+    """
+    Queue full request/response data for analysis (anthropic_request is the raw request body).
+    The writer derives the dated directory and filename prefix from request_id and start_ns.
+    """
     if not ENABLE_FULL_LOGGING:
         return
     
-    # Create date-based subdirectory
-    date_dir = LOG_DIR / datetime.now().strftime('%Y-%m-%d')
-    date_dir.mkdir(exist_ok=True)
-    
-    # Save all data
-    base_filename = f"{datetime.now().strftime('%H-%M-%S-%f')[:-3]}_{request_id}"
-    
-    # Save Anthropic request
-    with open(date_dir / f"{base_filename}_anthropic_request.json", 'w') as f:
-        json.dump(anthropic_request, f, indent=2)
-    
-    # Save OpenAI request
-    with open(date_dir / f"{base_filename}_openai_request.json", 'w') as f:
-        json.dump(openai_request, f, indent=2)
+    files = [
+        ("_anthropic_request.json", anthropic_request),
+        ("_openai_request.json", openai_request)
+    ]
     
-    # Save OpenAI response
     if openai_response:
-        with open(date_dir / f"{base_filename}_openai_response.json", 'w') as f:
-            if is_streaming and stream_content:
-                json.dump({"streaming": True, "content": stream_content}, f, indent=2)
-            else:
-                json.dump(openai_response, f, indent=2)
+        files.append(("_openai_response.json", openai_response))
     
-    # Save Anthropic response
     if anthropic_response:
-        with open(date_dir / f"{base_filename}_anthropic_response.json", 'w') as f:
-            json.dump(anthropic_response, f, indent=2)
+        files.append(("_anthropic_response.json", anthropic_response))
     
-    # Save metadata
-    with open(date_dir / f"{base_filename}_metadata.json", 'w') as f:
-        json.dump(metadata, f, indent=2)
+    files.append(("_metadata.json", metadata))
     
-    logging.info(f"Saved request/response logs to: {date_dir / base_filename}_*.json")
+    log_writer.submit(LogJob(LOG_DIR, files, request_id=request_id, timestamp_ns=start_ns))
+    logging.info("Queued request/response logs for %s", request_id)
 
-@app.route('/v1/messages', methods=['POST'])
-def proxy_messages():
-    start_time = datetime.now()
-    request_id = f"req_{datetime.now().strftime('%Y%m%d%H%M%S%f')[:-3]}"
-    
-    data = request.json
+@app.post('/v1/messages')
+async def proxy_messages(request: Request):
+    # One wall-clock snapshot for the id and log names, a monotonic clock for durations
+    start_ns = time.time_ns()
+    start_perf_ns = time.perf_counter_ns()
+    request_id = f"req_{start_ns}_{next(REQUEST_COUNTER)}"
     
-    # Save a copy of the original request before any modifications
-    original_anthropic_request = json.loads(json.dumps(data))
-    
-    # Capture request headers
-    request_headers = dict(request.headers)
-    
-    # Log request details
-    logging.info("="*80)
-    logging.info(f"NEW REQUEST {request_id}")
-    logging.info("="*80)
+    body = await request.body()
+    try:
+        data = orjson.loads(body)
+    except orjson.JSONDecodeError as e:
+        return invalid_request(f"Request body is not valid JSON: {e}")
+    if not isinstance(data, dict):
+        return invalid_request("Request body must be a JSON object")
     
-    # Log headers
-    logging.info("Request Headers:")
-    for header, value in request.headers:
-        logging.info(f"  {header}: {value}")
+    # The raw body is the unmodified original request; keep it (and the headers) only for full logging
+    original_anthropic_request = body if ENABLE_FULL_LOGGING else None
+    request_headers = dict(request.headers) if ENABLE_FULL_LOGGING else None
     
-    # Log original model
     original_model = data.get('model', 'not specified')
-    logging.info(f"\nOriginal Model: {original_model}")
     
-    # Log messages count
-    messages = data.get('messages', [])
-    logging.info(f"\nMessages: {len(messages)} total")
-    
-    # Log tools count
-    tools = data.get('tools', [])
-    logging.info(f"Tools: {len(tools)} total")
-    if tools:
+    # Log request details; the lookups below exist only for logging, so skip them when INFO is off
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        logging.info("%s\nNEW REQUEST %s\n%s", BANNER, request_id, BANNER)
+        
+        # Log headers
+        logging.info("Request Headers: %s", request_headers or request.headers)
+        
+        # Log original model
+        logging.info("\nOriginal Model: %s", original_model)
+        
+        # Log messages count
+        messages = data.get('messages', [])
+        logging.info("\nMessages: %d total", len(messages))
+        
+        # Log tools count
+        tools = data.get('tools', [])
+        logging.info("Tools: %d total", len(tools))
         for i, tool in enumerate(tools[:5]):  # Log first 5 tools
-            logging.info(f"  Tool {i}: {tool.get('name', 'unnamed')}")
-    
-    # Remove unsupported params
-    if 'cache_control' in data:
-        logging.info("\nRemoving unsupported parameter: cache_control")
-        del data['cache_control']
-    
-    # Clean up cache_control from nested structures
-    messages = data.get('messages', [])
-    for msg in messages:
-        if isinstance(msg, dict):
-            if 'cache_control' in msg:
-                logging.info(f"Removing cache_control from message with role: {msg.get('role', 'unknown')}")
-                del msg['cache_control']
-            
-            # Handle content if it's a list
-            content = msg.get('content', [])
-            if isinstance(content, list):
-                for item in content:
-                    if isinstance(item, dict) and 'cache_control' in item:
-                        logging.info("Removing cache_control from content item")
-                        del item['cache_control']
-    
-    # Clean system messages
-    system = data.get('system', [])
-    if isinstance(system, list):
-        for item in system:
-            if isinstance(item, dict) and 'cache_control' in item:
-                logging.info("Removing cache_control from system message")
-                del item['cache_control']
+            logging.info("  Tool %d: %s", i, tool.get('name', 'unnamed'))
     
-    # Remove tool_choice if present (xAI doesn't support it in the same format)
-    if 'tool_choice' in data:
-        logging.info("\nRemoving tool_choice parameter")
-        del data['tool_choice']
+    # Remove unsupported cache_control params from the request, messages, content and system blocks in one walk
+    removed = strip_cache_control(data)
+    if removed:
+        logging.debug("Removed %d unsupported cache_control parameter(s)", removed)
     
     # Map to grok-4 model
     data['model'] = 'grok-4'
-    logging.info(f"\nMapped model: {original_model} -> grok-4")
+    logging.info("\nMapped model: %s -> grok-4", original_model)
     
     # Convert Anthropic format to OpenAI format
     logging.info("\nConverting Anthropic format to OpenAI format...")
@@ -178,79 +177,84 @@ def proxy_messages():
         # Pass custom prompt template if enabled
         if USE_CUSTOM_PROMPT and custom_prompt_template:
             logging.info("Applying custom system prompt template")
-            config_file = PROMPT_CONFIG_FILE if os.path.exists(PROMPT_CONFIG_FILE) else None
-            openai_request = convert_anthropic_to_openai(data, custom_prompt_template, config_file)
+            openai_request = convert_anthropic_to_openai(data, custom_prompt_template, prompt_rewriter)
         else:
             openai_request = convert_anthropic_to_openai(data)
         
-        logging.info(f"Converted successfully. OpenAI messages: {len(openai_request['messages'])}")
+        logging.info("Converted successfully. OpenAI messages: %d", len(openai_request['messages']))
         if 'tools' in openai_request:
-            logging.info(f"OpenAI tools: {len(openai_request['tools'])}")
+            logging.info("OpenAI tools: %d", len(openai_request['tools']))
     except Exception as e:
-        logging.error(f"Error converting request: {str(e)}")
+        logging.error("Error converting request: %s", e)
         return Response(
-            json.dumps({"error": f"Failed to convert request: {str(e)}"}),
-            status=500,
-            content_type='application/json'
+            orjson.dumps({"error": f"Failed to convert request: {str(e)}"}),
+            status_code=500,
+            media_type='application/json'
         )
     
-    # Prepare headers with xAI auth
-    headers = {
-        'Authorization': f'Bearer {XAI_API_KEY}',
-        'Content-Type': 'application/json'
-    }
-    
     # Forward the request to xAI's OpenAI-compatible endpoint
     stream = data.get('stream', False)
-    logging.info(f"\nForwarding to xAI API: {XAI_BASE_URL}/chat/completions")
-    logging.info(f"Streaming: {stream}")
+    logging.info("\nForwarding to xAI API: %s/chat/completions\nStreaming: %s", XAI_BASE_URL, stream)
     
     try:
-        response = requests.post(
-            f'{XAI_BASE_URL}/chat/completions',
-            json=openai_request,
-            headers=headers,
-            stream=stream
-        )
+        upstream_request = client.build_request('POST', '/chat/completions', content=orjson.dumps(openai_request))
+        response = await client.send(upstream_request, stream=True)
         
-        logging.info(f"\nResponse Status: {response.status_code}")
+        logging.info("\nResponse Status: %d", response.status_code)
         
         # Handle errors
         if response.status_code != 200:
-            logging.error(f"Error response: {response.text}")
-            return Response(response.content, content_type=response.headers.get('Content-Type'), status=response.status_code)
+            await response.aread()
+            await response.aclose()
+            logging.error("Error response: %s", response.text)
+            return Response(response.content, media_type=response.headers.get('Content-Type'), status_code=response.status_code)
         
         # Handle streaming response with conversion
         if stream:
             logging.info("Converting and returning streaming response")
-            stream_chunks = []  # Collect stream chunks for logging
             
-            def generate():
-                state = {}  # Track streaming state
-                buffer = ""  # Buffer for incomplete lines
+            # Raw upstream lines are appended to an ndjson log in STREAM_LOG_CHUNK pieces,
+            # so memory stays flat however long the stream runs
+            def stream_log_job(lines):
+                return LogJob(LOG_DIR, [("_openai_response.ndjson", lines)], append=True,
+                              request_id=request_id, timestamp_ns=start_ns)
+            
+            async def generate():
+                state = StreamState()  # Track streaming state
+                pending = bytearray() if ENABLE_FULL_LOGGING else None
                 
-                for chunk in response.iter_lines(decode_unicode=True):
-                    if chunk:
-                        stream_chunks.append(chunk)  # Collect for logging
-                        # Convert OpenAI SSE to Anthropic SSE
-                        anthropic_events = convert_openai_stream_to_anthropic(chunk, state)
-                        for event in anthropic_events:
-                            yield f"{event}\n"
-                        if anthropic_events:  # Add blank line between events
-                            yield "\n"
+                try:
+                    # Lines stay as bytes; the converter parses them without a decode pass
+                    async for chunk in aiter_sse_lines(response.aiter_bytes()):
+                        if chunk:
+                            if pending is not None:
+                                pending += chunk
+                                pending += b"\n"
+                                if len(pending) >= STREAM_LOG_CHUNK:
+                                    log_writer.submit(stream_log_job(bytes(pending)))
+                                    pending.clear()
+                            # Convert OpenAI SSE to Anthropic SSE
+                            anthropic_events = convert_openai_stream_to_anthropic(chunk, state)
+                            for event in anthropic_events:
+                                yield f"{event}\n"
+                            if anthropic_events:  # Add blank line between events
+                                yield "\n"
+                finally:
+                    await response.aclose()
+                    if pending:
+                        log_writer.submit(stream_log_job(bytes(pending)))
+                
+                # Send the final newline first so the client isn't kept waiting on log work
+                yield "\n"
                 
                 # Log after streaming is complete
                 if ENABLE_FULL_LOGGING:
-                    end_time = datetime.now()
-                    metadata = {
-                        "request_id": request_id,
-                        "start_time": start_time.isoformat(),
-                        "end_time": end_time.isoformat(),
-                        "duration_ms": (end_time - start_time).total_seconds() * 1000,
-                        "streaming": True,
-                        "original_model": original_model,
-                        "headers": request_headers
-                    }
+                    metadata = _metadata_payload(
+                        request_id, start_ns, time.perf_counter_ns() - start_perf_ns,
+                        streaming=True,
+                        original_model=original_model,
+                        headers=request_headers
+                    )
                     save_request_response_logs(
                         request_id=request_id,
                         anthropic_request=original_anthropic_request,
@@ -258,16 +262,12 @@ def proxy_messages():
                         openai_response=None,
                         anthropic_response=None,
                         metadata=metadata,
-                        is_streaming=True,
-                        stream_content=stream_chunks
+                        start_ns=start_ns
                     )
-                
-                # Ensure we send a final newline
-                yield "\n"
             
-            return Response(
+            return StreamingResponse(
                 generate(),
-                content_type='text/event-stream',
+                media_type='text/event-stream',
                 headers={
                     'Cache-Control': 'no-cache',
                     'X-Accel-Buffering': 'no',  # Disable Nginx buffering
@@ -277,59 +277,62 @@ def proxy_messages():
         
         # Non-streaming: Convert OpenAI response back to Anthropic format
         logging.info("Converting OpenAI response to Anthropic format...")
+        await response.aread()
+        await response.aclose()
+        raw = response.content
         try:
-            openai_response = response.json()
-            logging.info(f"OpenAI response: {json.dumps(openai_response, indent=2)}")
+            # Parse once; the debug line and the request log both reuse the raw bytes
+            openai_response = orjson.loads(raw)
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug("OpenAI response: %s", raw.decode('utf-8', errors='replace'))
             anthropic_response = convert_openai_to_anthropic(openai_response)
             
             # Log usage info
             if 'usage' in anthropic_response:
                 usage = anthropic_response['usage']
-                logging.info(f"Usage - Input tokens: {usage['input_tokens']}, Output tokens: {usage['output_tokens']}")
+                logging.info("Usage - Input tokens: %s, Output tokens: %s", usage['input_tokens'], usage['output_tokens'])
             
             # Save full request/response logs
             if ENABLE_FULL_LOGGING:
-                end_time = datetime.now()
-                metadata = {
-                    "request_id": request_id,
-                    "start_time": start_time.isoformat(),
-                    "end_time": end_time.isoformat(),
-                    "duration_ms": (end_time - start_time).total_seconds() * 1000,
-                    "streaming": False,
-                    "original_model": original_model,
-                    "headers": request_headers,
-                    "usage": {
+                metadata = _metadata_payload(
+                    request_id, start_ns, time.perf_counter_ns() - start_perf_ns,
+                    streaming=False,
+                    original_model=original_model,
+                    headers=request_headers,
+                    usage={
                         "input_tokens": anthropic_response.get('usage', {}).get('input_tokens', 0),
                         "output_tokens": anthropic_response.get('usage', {}).get('output_tokens', 0),
                         "reasoning_tokens": openai_response.get('usage', {}).get('completion_tokens_details', {}).get('reasoning_tokens', 0)
                     }
-                }
+                )
                 save_request_response_logs(
                     request_id=request_id,
                     anthropic_request=original_anthropic_request,
                     openai_request=openai_request,
-                    openai_response=openai_response,
+                    openai_response=raw,
                     anthropic_response=anthropic_response,
-                    metadata=metadata
+                    metadata=metadata,
+                    start_ns=start_ns
                 )
             
             return Response(
-                json.dumps(anthropic_response),
-                content_type='application/json',
-                status=200
+                orjson.dumps(anthropic_response),
+                media_type='application/json',
+                status_code=200
             )
         except Exception as e:
-            logging.error(f"Error converting response: {str(e)}")
+            logging.error("Error converting response: %s", e)
             # Return original response if conversion fails
-            return Response(response.content, content_type=response.headers.get('Content-Type'), status=response.status_code)
+            return Response(raw, media_type=response.headers.get('Content-Type'), status_code=response.status_code)
         
     except Exception as e:
-        logging.error(f"Error forwarding request: {str(e)}")
+        logging.error("Error forwarding request: %s", e)
         return Response(
-            json.dumps({"error": f"Failed to forward request: {str(e)}"}),
-            status=500,
-            content_type='application/json'
+            orjson.dumps({"error": f"Failed to forward request: {str(e)}"}),
+            status_code=500,
+            media_type='application/json'
         )
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8000, debug=True)  # Debug mode for testing; remove for production
\ No newline at end of file
+    # Each worker is a separate process with its own event loop and upstream connection pool
+    uvicorn.run('grok_proxy_openai:app', host='0.0.0.0', port=8000, workers=WORKERS)
\ No newline at end of file
@@ -0,0 +1,191 @@
+"""
+Background writer for request/response log files
+"""
+import os
+import queue
+import struct
+import atexit
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Iterator, List, Optional, Tuple
+import msgspec
+import orjson
+import zstandard
+
+logger = logging.getLogger(__name__)
+
+FRAME_HEADER = struct.Struct('>I')  # Length prefix of each MessagePack frame
+_msgpack_encoder = msgspec.msgpack.Encoder()
+
+
+@dataclass
+class LogJob:
+    """Files to write for one request: (filename, payload) pairs under directory.
+    A payload is bytes, a JSON-serializable object, or a callable returning either.
+    With timestamp_ns set, the writer files them in a dated subdirectory of directory
+    and prefixes each filename with the time of day and request_id."""
+    directory: Path
+    files: List[Tuple[str, Any]]
+    append: bool = False  # Append to existing files instead of replacing them
+    request_id: Optional[str] = None
+    timestamp_ns: Optional[int] = None  # Request start time, formatted on the writer thread
+
+
+class LogWriter:
+    """
+    Write LogJobs on a daemon thread so request handlers never touch the disk.
+    Pending jobs are drained and written together on each wakeup, and files are
+    fsynced once the queue has been idle for flush_interval seconds, or sooner once
+    max_unsynced files have been written since the last sync.
+    With compress=True every file is written as a zstd frame and gets a .zst suffix;
+    appends add further frames, which zstd tools decompress as one stream.
+    With max_pending set, jobs submitted while that many are queued are dropped and
+    counted in `dropped` rather than blocking the caller.
+    """
+
+    def __init__(self, flush_interval: float = 1.0, batch_size: int = 256, compress: bool = False,
+                 max_pending: int = 0, max_unsynced: int = 256):
+        self._queue = queue.Queue(max_pending)
+        self.dropped = 0
+        self._flush_interval = flush_interval
+        self._batch_size = batch_size
+        self._max_unsynced = max_unsynced
+        self._compressor = zstandard.ZstdCompressor(level=1) if compress else None
+        self._created_dirs = set()
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, job: LogJob) -> None:
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            self.dropped += 1
+            logger.warning("Log queue full, dropped logs for %s (%d dropped so far)", job.directory, self.dropped)
+
+    def close(self, timeout: float = 5.0) -> None:
+        """Write everything still queued, then stop the worker."""
+        if self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=timeout)
+            except queue.Full:
+                return
+            self._thread.join(timeout)
+
+    def _run(self) -> None:
+        unsynced = set()
+        while True:
+            try:
+                job = self._queue.get(timeout=self._flush_interval)
+            except queue.Empty:
+                self._sync(unsynced)
+                continue
+
+            # Coalesce everything already queued into one batch
+            jobs = [job]
+            while len(jobs) < self._batch_size:
+                try:
+                    jobs.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = False
+            for job in jobs:
+                if job is None:
+                    stop = True
+                    continue
+                try:
+                    self._write(job, unsynced)
+                except Exception:
+                    logger.exception("Failed to write request logs to %s", job.directory)
+
+            # Steady traffic never leaves the queue idle, so also sync once enough has piled up
+            if stop or len(unsynced) >= self._max_unsynced:
+                self._sync(unsynced)
+            if stop:
+                return
+
+    def _write(self, job: LogJob, unsynced: set) -> None:
+        directory = job.directory
+        prefix = ''
+        if job.timestamp_ns is not None:
+            when = datetime.fromtimestamp(job.timestamp_ns / 1e9)
+            directory = directory / when.strftime('%Y-%m-%d')
+            prefix = f"{when.strftime('%H-%M-%S-%f')[:-3]}_{job.request_id}"
+        if directory not in self._created_dirs:
+            directory.mkdir(parents=True, exist_ok=True)
+            self._created_dirs.add(directory)
+
+        compressor = self._compressor
+        for filename, payload in job.files:
+            path = directory / (f"{prefix}{filename}.zst" if compressor else f"{prefix}{filename}")
+            # Callables are evaluated here so callers can defer work to this thread
+            if callable(payload):
+                payload = payload()
+            # Bytes are written verbatim; anything else is encoded here, off the request path
+            if not isinstance(payload, bytes):
+                payload = orjson.dumps(payload, option=orjson.OPT_INDENT_2)
+            if compressor:
+                payload = compressor.compress(payload)
+            with open(path, 'ab' if job.append else 'wb', buffering=1 << 16) as f:
+                f.write(payload)
+            unsynced.add(path)
+
+    @staticmethod
+    def _sync(paths: set) -> None:
+        for path in paths:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        paths.clear()
+
+
+def setup_queue_logging(filename: str, console: bool = True) -> QueueListener:
+    """
+    Log to filename (and stderr when console is set) through a queue, so callers never
+    block on log I/O: records are formatted and written by a background listener thread.
+    """
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    handlers = [logging.FileHandler(filename)]
+    if console:
+        handlers.append(logging.StreamHandler())
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    queue_handler = QueueHandler(queue.Queue(-1))
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))  # Final formatting happens in the listener
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+    listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def msgpack_frame(record: Any) -> bytes:
+    """Encode record as one length-prefixed MessagePack frame, for appending to a rolling log file"""
+    body = _msgpack_encoder.encode(record)
+    return FRAME_HEADER.pack(len(body)) + body
+
+
+def read_msgpack_frames(path) -> Iterator[Any]:
+    """Yield the records of a file written with msgpack_frame; a truncated final frame is skipped"""
+    decoder = msgspec.msgpack.Decoder()
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                return
+            (length,) = FRAME_HEADER.unpack(header)
+            body = f.read(length)
+            if len(body) < length:
+                return
+            yield decoder.decode(body)
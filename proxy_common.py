@@ -0,0 +1,27 @@
+"""
+Helpers shared by the FastAPI proxies
+"""
+import logging
+from contextlib import asynccontextmanager
+from fastapi.responses import Response
+import httpx
+import orjson
+
+
+def invalid_request(message: str) -> Response:
+    """Anthropic-style 400 invalid_request_error response"""
+    logging.error("Invalid request: %s", message)
+    return Response(
+        orjson.dumps({"type": "error", "error": {"type": "invalid_request_error", "message": message}}),
+        status_code=400,
+        media_type='application/json'
+    )
+
+
+def client_lifespan(client: httpx.AsyncClient):
+    """FastAPI lifespan that closes the shared upstream client on shutdown"""
+    @asynccontextmanager
+    async def lifespan(app):
+        yield
+        await client.aclose()
+    return lifespan
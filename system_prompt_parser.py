@@ -1,6 +1,27 @@
 import re
 import json
-from typing import Dict, Optional, Tuple, Any
+from typing import Any, Callable, Dict, List, Optional, Pattern, Sequence, Tuple, Union
+
+# Precompiled patterns for parsing and rewriting system prompts
+ENV_RE = re.compile(r'<env>(.*?)</env>', re.DOTALL)
+MODEL_INFO_RE = re.compile(r'(You are powered by the model named.*?Assistant knowledge cutoff is [^\n]+)', re.DOTALL)
+MCP_RE = re.compile(r'(# MCP Server Instructions.*?)(?=\n#|\nIMPORTANT:|\Z)', re.DOTALL)
+EXTRA_NEWLINES_RE = re.compile(r'\n{3,}')
+CLAUDE_CODE_RE = re.compile(r'Claude Code')
+CLAUDE_AI_URL_RE = re.compile(r'claude\.ai/code')
+YOU_ARE_CLAUDE_RE = re.compile(r'You are Claude Code[^.]*\.')
+ANTHROPIC_CLI_RE = re.compile(r'Anthropic\'s official CLI for Claude')
+FEEDBACK_URL_RE = re.compile(r'https://github\.com/anthropics/claude-code/issues')
+DOCS_URL_RE = re.compile(r'https://docs\.anthropic\.com/en/docs/claude-code[^\\s]*')
+DOCS_SECTION_RE = re.compile(
+    r'When the user directly asks about Claude Code.*?Example: https://docs\.anthropic\.com/en/docs/claude-code/cli-usage\n',
+    re.DOTALL
+)
+DEFENSIVE_SECURITY_RE = re.compile(r'IMPORTANT: Assist with defensive security tasks only\.[^.]+\.')
+URL_RESTRICTION_RE = re.compile(r'IMPORTANT: You must NEVER generate or guess URLs[^.]+\.')
+OPUS_4_RE = re.compile(r'Opus 4')
+OPUS_MODEL_ID_RE = re.compile(r'claude-opus-4-\d+')
+HELP_SECTION_RE = re.compile(r'If the user asks for help[^:]+:\s*\n(?:- [^\n]+\n)*')
 
 def parse_system_prompt(system_text: str) -> Dict[str, str]:
     """
@@ -10,35 +31,29 @@ def parse_system_prompt(system_text: str) -> Dict[str, str]:
     sections = {}
     
     # Extract environment info
-    env_match = re.search(r'<env>(.*?)</env>', system_text, re.DOTALL)
+    env_match = ENV_RE.search(system_text)
     if env_match:
         sections['env_info'] = env_match.group(0)  # Include tags
     
     # Extract model info (everything from "You are powered by" to the next section)
-    model_match = re.search(
-        r'(You are powered by the model named.*?Assistant knowledge cutoff is [^\n]+)',
-        system_text, re.DOTALL
-    )
+    model_match = MODEL_INFO_RE.search(system_text)
     if model_match:
         sections['model_info'] = model_match.group(1)
     
     # Extract MCP Server Instructions if present
-    mcp_match = re.search(
-        r'(# MCP Server Instructions.*?)(?=\n#|\nIMPORTANT:|\Z)',
-        system_text, re.DOTALL
-    )
+    mcp_match = MCP_RE.search(system_text)
     if mcp_match:
         sections['mcp_instructions'] = mcp_match.group(1)
     
     # Extract the main content (everything else)
-    # Remove the extracted sections to get the main content
+    # Remove every occurrence of each extracted section to get the main content
     main_content = system_text
-    for key, value in sections.items():
-        if value and key != 'main_content':
+    for value in sections.values():
+        if value:
             main_content = main_content.replace(value, '')
     
     # Clean up extra newlines
-    main_content = re.sub(r'\n{3,}', '\n\n', main_content).strip()
+    main_content = EXTRA_NEWLINES_RE.sub('\n\n', main_content).strip()
     sections['main_content'] = main_content
     
     return sections
@@ -63,7 +78,7 @@ def apply_custom_template(template: str, sections: Dict[str, str]) -> str:
         result = result.replace(placeholder, value)
     
     # Clean up extra newlines
-    result = re.sub(r'\n{3,}', '\n\n', result)
+    result = EXTRA_NEWLINES_RE.sub('\n\n', result)
     
     return result.strip()
 
@@ -80,63 +95,42 @@ def split_intro_and_content(system_text: str) -> Tuple[str, str]:
     return system_text.strip(), ""
 
 
-def apply_prompt_config(prompt: str, config: Dict[str, Any]) -> str:
+def build_prompt_rules(config: Dict[str, Any]) -> List[Tuple[Pattern, Union[str, Callable]]]:
     """
-    Apply configuration-based transformations to the prompt.
+    Turn a prompt configuration into an ordered list of (pattern, replacement) rules.
+    Order matters: later rules see the text produced by earlier ones.
     """
-    result = prompt
+    rules = []
     
     # Remove Claude/Anthropic references if configured
     if config.get('remove_claude_references', False):
-        result = re.sub(r'Claude Code', config.get('system_name', 'AI Assistant'), result)
-        result = re.sub(r'claude\.ai/code', '', result)
-        result = re.sub(r'You are Claude Code[^.]*\.', f"You are {config.get('system_name', 'an AI assistant')}.", result)
+        rules.append((CLAUDE_CODE_RE, config.get('system_name', 'AI Assistant')))
+        rules.append((CLAUDE_AI_URL_RE, ''))
+        rules.append((YOU_ARE_CLAUDE_RE, f"You are {config.get('system_name', 'an AI assistant')}."))
     
     if config.get('remove_anthropic_references', False):
-        result = re.sub(r'Anthropic\'s official CLI for Claude', 'an advanced AI coding assistant', result)
-        feedback_url = config.get('custom_help_info', {}).get('feedback_url', '')
-        if feedback_url:
-            result = re.sub(r'https://github\.com/anthropics/claude-code/issues', feedback_url, result)
-        else:
-            result = re.sub(r'https://github\.com/anthropics/claude-code/issues', '', result)
-        
-        doc_url = config.get('custom_help_info', {}).get('documentation_url', '')
-        if doc_url:
-            result = re.sub(r'https://docs\.anthropic\.com/en/docs/claude-code[^\\s]*', doc_url, result)
-        else:
-            result = re.sub(r'https://docs\.anthropic\.com/en/docs/claude-code[^\\s]*', '', result)
+        rules.append((ANTHROPIC_CLI_RE, 'an advanced AI coding assistant'))
+        rules.append((FEEDBACK_URL_RE, config.get('custom_help_info', {}).get('feedback_url') or ''))
+        rules.append((DOCS_URL_RE, config.get('custom_help_info', {}).get('documentation_url') or ''))
         # Remove the entire Claude Code documentation section
-        result = re.sub(
-            r'When the user directly asks about Claude Code.*?Example: https://docs\.anthropic\.com/en/docs/claude-code/cli-usage\n',
-            '',
-            result,
-            flags=re.DOTALL
-        )
+        rules.append((DOCS_SECTION_RE, ''))
     
     # Remove defensive restrictions if configured
     if config.get('remove_defensive_restrictions', False):
         # Remove security restrictions
-        result = re.sub(
-            r'IMPORTANT: Assist with defensive security tasks only\.[^.]+\.',
-            '',
-            result
-        )
+        rules.append((DEFENSIVE_SECURITY_RE, ''))
         # Remove URL generation restrictions
-        result = re.sub(
-            r'IMPORTANT: You must NEVER generate or guess URLs[^.]+\.',
-            '',
-            result
-        )
+        rules.append((URL_RESTRICTION_RE, ''))
     
     # Update model references
     if config.get('model_name_override'):
-        result = re.sub(r'Opus 4', config['model_name_override'], result)
-        result = re.sub(r'claude-opus-4-\d+', config['model_name_override'].lower().replace(' ', '-'), result)
+        rules.append((OPUS_4_RE, config['model_name_override']))
+        rules.append((OPUS_MODEL_ID_RE, config['model_name_override'].lower().replace(' ', '-')))
     
-    # Apply custom placeholders
+    # Apply custom placeholders (literal text, so the value is returned from a callable)
     placeholders = config.get('placeholders', {})
     for placeholder, value in placeholders.items():
-        result = result.replace(placeholder, value)
+        rules.append((re.compile(re.escape(placeholder)), lambda match, value=value: value))
     
     # Update help/feedback section
     if config.get('custom_help_info'):
@@ -149,18 +143,42 @@ def apply_prompt_config(prompt: str, config: Dict[str, Any]) -> str:
                 new_help_section += f"- To give feedback: {help_info['feedback_url']}\n"
             
             # Replace the existing help section
-            result = re.sub(
-                r'If the user asks for help[^:]+:\s*\n(?:- [^\n]+\n)*',
-                new_help_section,
-                result
-            )
+            rules.append((HELP_SECTION_RE, new_help_section))
     
     # Clean up extra newlines
-    result = re.sub(r'\n{3,}', '\n\n', result)
+    rules.append((EXTRA_NEWLINES_RE, '\n\n'))
     
+    return rules
+
+
+def apply_prompt_rules(prompt: str, rules: Sequence[Tuple[Pattern, Union[str, Callable]]]) -> str:
+    """Run the rules from build_prompt_rules over the prompt in order."""
+    result = prompt
+    for pattern, replacement in rules:
+        result = pattern.sub(replacement, result)
     return result.strip()
 
 
+def build_prompt_rewriter(config: Dict[str, Any]) -> Callable[[str], str]:
+    """
+    Specialize apply_prompt_config for one configuration.
+    The config is inspected once; the returned function only runs the active rules.
+    """
+    rules = tuple(build_prompt_rules(config))
+    
+    def rewrite(prompt: str) -> str:
+        return apply_prompt_rules(prompt, rules)
+    
+    return rewrite
+
+
+def apply_prompt_config(prompt: str, config: Dict[str, Any]) -> str:
+    """
+    Apply configuration-based transformations to the prompt.
+    """
+    return apply_prompt_rules(prompt, build_prompt_rules(config))
+
+
 def load_prompt_config(config_file: str) -> Dict[str, Any]:
     """Load prompt configuration from JSON file."""
     try:
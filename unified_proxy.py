@@ -1,24 +1,26 @@
 import os
-import json
+import time
 import logging
 from datetime import datetime
 from pathlib import Path
-from flask import Flask, request, Response
-import requests
-from converter import convert_anthropic_to_openai, convert_openai_to_anthropic, convert_openai_stream_to_anthropic
-from system_prompt_parser import parse_system_prompt, apply_custom_template, apply_prompt_config, load_prompt_config
+from typing import List, Union
+from fastapi import FastAPI, Request
+from fastapi.responses import Response, StreamingResponse
+import httpx
+import msgspec
+import orjson
+import uvicorn
+from proxy_common import client_lifespan, invalid_request
+from log_writer import LogJob, LogWriter, msgpack_frame, setup_queue_logging
+from converter import StreamState, aiter_sse_line_batches, apply_custom_system_prompt, convert_anthropic_to_openai, convert_openai_to_anthropic, convert_openai_stream_to_anthropic
+from system_prompt_parser import build_prompt_rewriter, load_prompt_config
 
-app = Flask(__name__)
-
-# Set up logging to file
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('unified_proxy.log'),
-        logging.StreamHandler()  # Also log to console
-    ]
-)
+# Set up logging to file, and to the console only if LOG_TO_CONSOLE is set to spare
+# production the stderr writes. Records are written by a background listener thread.
+LOG_TO_CONSOLE = os.environ.get('LOG_TO_CONSOLE', 'false').lower() == 'true'
+setup_queue_logging('unified_proxy.log', console=LOG_TO_CONSOLE)
+# httpx logs every upstream call at INFO; keep the one record per request our own
+logging.getLogger('httpx').setLevel(logging.WARNING)
 
 # Configuration
 BACKEND = os.environ.get('BACKEND', 'grok').lower()  # 'grok' or 'anthropic'
@@ -34,72 +36,113 @@ elif BACKEND == 'anthropic' and not ANTHROPIC_API_KEY:
 # API endpoints
 XAI_BASE_URL = 'https://api.x.ai/v1'
 ANTHROPIC_BASE_URL = 'https://api.anthropic.com/v1'
+XAI_URL = f'{XAI_BASE_URL}/chat/completions'
+ANTHROPIC_URL = f'{ANTHROPIC_BASE_URL}/messages'
+
+# Upstream headers are fixed per process; only the Anthropic version and forwarded headers vary per request
+XAI_HEADERS = {
+    'Authorization': f'Bearer {XAI_API_KEY}',
+    'Content-Type': 'application/json'
+}
+ANTHROPIC_HEADERS = {
+    'x-api-key': ANTHROPIC_API_KEY,
+    'Content-Type': 'application/json'
+}
+ANTHROPIC_FORWARDED_HEADERS = ('anthropic-beta', 'anthropic-dangerous-direct-browser-access')
+
+# Content codings httpx can decode with this project's requirements (zstd via zstandard, no brotli);
+# error bodies of streamed requests are decoded, so only these are requested upstream
+DECODABLE_ENCODINGS = frozenset(('gzip', 'deflate', 'zstd', 'identity'))
+
+# Number of uvicorn worker processes when run as a script
+WORKERS = int(os.environ.get('WORKERS', '1'))
+
+# Shared async client for both backends: upstream calls are multiplexed on the event loop
+# instead of holding a worker thread each. Idle connections are kept for a minute (httpx
+# defaults to 5s) so requests arriving between bursts skip the TCP+TLS handshake.
+# The transport retries failed connection attempts only; a sent request is never replayed.
+client = httpx.AsyncClient(
+    timeout=httpx.Timeout(None, connect=10),
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=2,
+        limits=httpx.Limits(max_connections=1000, max_keepalive_connections=200, keepalive_expiry=60)
+    )
+)
+
+app = FastAPI(lifespan=client_lifespan(client))
 
 # Enable full logging
 ENABLE_FULL_LOGGING = os.environ.get('ENABLE_FULL_LOGGING', 'true').lower() == 'true'
 LOG_DIR = Path(os.environ.get('LOG_DIR', 'logs/requests'))
+LOG_QUEUE_SIZE = 10_000  # Pending log jobs beyond this are dropped rather than blocking requests
+LOG_FILE_NAME = 'log.msgpack'  # Daily rolling file of MessagePack frames, one per request
+_DATE_CACHE = {"day": None, "dir": None}  # Today's log directory, rebuilt when the date changes
 
 # Enable custom system prompt
 USE_CUSTOM_PROMPT = os.environ.get('USE_CUSTOM_PROMPT', 'false').lower() == 'true'
 CUSTOM_PROMPT_FILE = os.environ.get('CUSTOM_PROMPT_FILE', 'system_prompt_template_unrestricted.txt')
 PROMPT_CONFIG_FILE = os.environ.get('PROMPT_CONFIG_FILE', 'prompt_config.json')
 
-# Load custom prompt template if enabled
+# Load custom prompt template and configuration once if enabled; the config is
+# compiled into a rewrite function that only runs the rules it enables
 custom_prompt_template = None
+prompt_rewriter = None
 if USE_CUSTOM_PROMPT:
     try:
         with open(CUSTOM_PROMPT_FILE, 'r') as f:
             custom_prompt_template = f.read()
-        logging.info(f"Custom system prompt enabled. Loaded template from: {CUSTOM_PROMPT_FILE}")
+        logging.info("Custom system prompt enabled. Loaded template from: %s", CUSTOM_PROMPT_FILE)
         
         # Check if config file exists
         if os.path.exists(PROMPT_CONFIG_FILE):
-            logging.info(f"Using prompt configuration from: {PROMPT_CONFIG_FILE}")
+            prompt_rewriter = build_prompt_rewriter(load_prompt_config(PROMPT_CONFIG_FILE))
+            logging.info("Using prompt configuration from: %s", PROMPT_CONFIG_FILE)
     except Exception as e:
-        logging.error(f"Failed to load custom prompt template: {e}")
+        logging.error("Failed to load custom prompt template: %s", e)
         USE_CUSTOM_PROMPT = False
 
-# Create log directory structure
+# Create log directory structure; log files are written off the request path by a background thread
+log_writer = None
 if ENABLE_FULL_LOGGING:
     LOG_DIR.mkdir(parents=True, exist_ok=True)
-    logging.info(f"Full logging enabled. Logs will be saved to: {LOG_DIR}")
+    log_writer = LogWriter(max_pending=LOG_QUEUE_SIZE)
+    logging.info("Full logging enabled. Logs will be saved to: %s", LOG_DIR)
+
+logging.info("Starting unified proxy with backend: %s", BACKEND)
 
-logging.info(f"Starting unified proxy with backend: {BACKEND}")
+class TextBlock(msgspec.Struct):
+    """A system prompt block; other keys such as cache_control are ignored"""
+    type: str
+    text: str = ""  # Absent on non-text blocks, which are passed through unchanged
+
+SystemPrompt = Union[str, List[TextBlock]]
 
 def apply_custom_system_prompt_to_request(data):
-    """Apply custom system prompt to the request if enabled"""
+    """
+    Apply custom system prompt to the request if enabled.
+    Raises msgspec.ValidationError if the system field is malformed.
+    """
     if not USE_CUSTOM_PROMPT or not custom_prompt_template:
         return data
     
     # Apply to system field if present
     if 'system' in data:
+        system = msgspec.convert(data['system'], type=SystemPrompt)
         try:
-            config_file = PROMPT_CONFIG_FILE if os.path.exists(PROMPT_CONFIG_FILE) else None
-            
-            # Parse and apply custom template
-            if isinstance(data['system'], str):
-                sections = parse_system_prompt(data['system'])
-                modified_prompt = apply_custom_template(custom_prompt_template, sections)
-                if config_file:
-                    config = load_prompt_config(config_file)
-                    modified_prompt = apply_prompt_config(modified_prompt, config)
-                data['system'] = modified_prompt
-            elif isinstance(data['system'], list):
+            # Parse and apply custom template; results are memoized by system text, which
+            # barely changes between the requests of a session
+            if isinstance(system, str):
+                data['system'] = apply_custom_system_prompt(system, custom_prompt_template, prompt_rewriter)
+            else:
                 # Handle array format - concatenate all text blocks
-                full_text = ""
-                for block in data['system']:
-                    if isinstance(block, dict) and block.get("type") == "text":
-                        full_text += block["text"] + "\n"
+                full_text = "\n".join(block.text for block in system if block.type == "text")
                 
-                sections = parse_system_prompt(full_text.strip())
-                modified_prompt = apply_custom_template(custom_prompt_template, sections)
-                if config_file:
-                    config = load_prompt_config(config_file)
-                    modified_prompt = apply_prompt_config(modified_prompt, config)
+                modified_prompt = apply_custom_system_prompt(full_text, custom_prompt_template, prompt_rewriter)
                 
                 # Replace all text blocks with a single modified block
                 # Remove all existing text blocks
-                data['system'] = [block for block in data['system'] if not (isinstance(block, dict) and block.get("type") == "text")]
+                data['system'] = [raw for raw, block in zip(data['system'], system) if block.type != "text"]
                 
                 # Add the modified prompt as a single text block at the beginning
                 data['system'].insert(0, {
@@ -108,58 +151,70 @@ def apply_custom_system_prompt_to_request(data):
                     "cache_control": {"type": "ephemeral"}
                 })
             
-            logging.info("Applied custom system prompt")
+            logging.debug("Applied custom system prompt")
         except Exception as e:
-            logging.error(f"Error applying custom prompt: {e}")
+            logging.error("Error applying custom prompt: %s", e)
     
     return data
 
-def save_request_response_logs(request_id, request_data, response_data, metadata):
-    """Save full request/response data for analysis"""
+def save_request_response_logs(request_id, request_data, response_data, metadata, started):
+    """
+    Queue full request/response data for analysis.
+    Each request becomes one length-prefixed MessagePack frame appended to the day's
+    log.msgpack (read it back with log_writer.read_msgpack_frames). Raw request and
+    response bodies are stored as MessagePack binary.
+    """
     if not ENABLE_FULL_LOGGING:
         return
     
-    # Create date-based subdirectory
-    date_dir = LOG_DIR / datetime.now().strftime('%Y-%m-%d')
-    date_dir.mkdir(exist_ok=True)
-    
-    # Save all data
-    base_filename = f"{datetime.now().strftime('%H-%M-%S-%f')[:-3]}_{request_id}"
+    # Date-based subdirectory, cached for the day; the writer creates it
+    day = started.date()
+    if _DATE_CACHE["day"] != day:
+        _DATE_CACHE.update(day=day, dir=LOG_DIR / day.isoformat())
+    date_dir = _DATE_CACHE["dir"]
+    record = {"request": request_data, "response": response_data, "metadata": metadata}
     
-    # Save request
-    with open(date_dir / f"{base_filename}_request.json", 'w') as f:
-        json.dump(request_data, f, indent=2)
-    
-    # Save response
-    if response_data:
-        with open(date_dir / f"{base_filename}_response.json", 'w') as f:
-            json.dump(response_data, f, indent=2)
-    
-    # Save metadata
-    with open(date_dir / f"{base_filename}_metadata.json", 'w') as f:
-        json.dump(metadata, f, indent=2)
-    
-    logging.info(f"Saved request/response logs to: {date_dir / base_filename}_*.json")
+    # Encoded on the writer thread
+    log_writer.submit(LogJob(date_dir, [(LOG_FILE_NAME, lambda: msgpack_frame(record))], append=True))
+    logging.debug("Queued request/response logs for %s to: %s", request_id, date_dir / LOG_FILE_NAME)
 
-@app.route('/v1/messages', methods=['POST'])
-def proxy_messages():
-    start_time = datetime.now()
-    request_id = f"req_{datetime.now().strftime('%Y%m%d%H%M%S%f')[:-3]}"
+def _upstream_accept_encoding(client_accept_encoding):
+    """The client's Accept-Encoding restricted to DECODABLE_ENCODINGS, or identity"""
+    if not client_accept_encoding:
+        return 'identity'
+    accepted = [
+        coding.strip() for coding in client_accept_encoding.split(',')
+        if coding.split(';', 1)[0].strip().lower() in DECODABLE_ENCODINGS
+    ]
+    return ', '.join(accepted) or 'identity'
+
+@app.post('/v1/messages')
+async def proxy_messages(request: Request):
+    # One wall-clock snapshot for the id and log location, a monotonic clock for durations
+    started = datetime.now()
+    start_perf_ns = time.perf_counter_ns()
+    request_id = f"req_{started:%Y%m%d%H%M%S}{started.microsecond // 1000:03d}"
     
-    data = request.json
-    original_request = json.loads(json.dumps(data))  # Deep copy
+    body = await request.body()
+    try:
+        data = orjson.loads(body)
+    except orjson.JSONDecodeError as e:
+        return invalid_request(f"Request body is not valid JSON: {e}")
+    if not isinstance(data, dict):
+        return invalid_request("Request body must be a JSON object")
+    original_request = body  # The untouched request is logged as the raw bytes received
     
-    # Log request details
-    logging.info("="*80)
-    logging.info(f"NEW REQUEST {request_id}")
-    logging.info("="*80)
-    logging.info(f"Backend: {BACKEND}")
-    logging.info(f"Model: {data.get('model', 'not specified')}")
-    logging.info(f"Messages: {len(data.get('messages', []))}")
+    # Log request details as one record; the lookups exist only for logging, so skip them when INFO is off
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        logging.info("NEW REQUEST %s backend=%s model=%s messages=%d",
+                     request_id, BACKEND, data.get('model', 'not specified'), len(data.get('messages', [])))
     
     # Apply custom system prompt if enabled
     if USE_CUSTOM_PROMPT:
-        data = apply_custom_system_prompt_to_request(data)
+        try:
+            data = apply_custom_system_prompt_to_request(data)
+        except msgspec.ValidationError as e:
+            return invalid_request(f"Invalid system prompt: {e}")
     
     # Prepare for the appropriate backend
     if BACKEND == 'grok':
@@ -172,46 +227,48 @@ def proxy_messages():
             # Convert to OpenAI format
             openai_request = convert_anthropic_to_openai(data)
             
-            # Remove unsupported parameters
-            if 'tool_choice' in openai_request:
-                del openai_request['tool_choice']
-            
             # Send to xAI
-            headers = {
-                'Authorization': f'Bearer {XAI_API_KEY}',
-                'Content-Type': 'application/json'
-            }
-            
             stream = data.get('stream', False)
-            response = requests.post(
-                f'{XAI_BASE_URL}/chat/completions',
-                json=openai_request,
-                headers=headers,
-                stream=stream
+            upstream_request = client.build_request(
+                'POST',
+                XAI_URL,
+                content=orjson.dumps(openai_request),
+                headers=XAI_HEADERS
             )
+            response = await client.send(upstream_request, stream=True)
             
-            logging.info(f"xAI Response Status: {response.status_code}")
+            logging.debug("xAI Response Status: %d", response.status_code)
             
             if response.status_code != 200:
-                logging.error(f"xAI Error: {response.text}")
-                return Response(response.content, content_type=response.headers.get('Content-Type'), status=response.status_code)
+                await response.aread()
+                await response.aclose()
+                logging.error("xAI Error: %s", response.text)
+                return Response(response.content, media_type=response.headers.get('Content-Type'), status_code=response.status_code)
             
             # Handle streaming
             if stream:
-                def generate():
-                    state = {}
-                    for chunk in response.iter_lines(decode_unicode=True):
-                        if chunk:
-                            anthropic_events = convert_openai_stream_to_anthropic(chunk, state)
-                            for event in anthropic_events:
-                                yield f"{event}\n"
-                            if anthropic_events:
-                                yield "\n"
-                    yield "\n"
+                async def generate():
+                    state = StreamState()
+                    try:
+                        # Events converted from one upstream read go out in a single write,
+                        # framed and encoded once
+                        async for lines in aiter_sse_line_batches(response.aiter_bytes()):
+                            out = []
+                            for chunk in lines:
+                                if chunk:
+                                    anthropic_events = convert_openai_stream_to_anthropic(chunk, state)
+                                    if anthropic_events:
+                                        out.append("\n".join(anthropic_events))
+                                        out.append("\n\n")
+                            if out:
+                                yield "".join(out).encode()
+                    finally:
+                        await response.aclose()
+                    yield b"\n"
                 
-                return Response(
+                return StreamingResponse(
                     generate(),
-                    content_type='text/event-stream',
+                    media_type='text/event-stream',
                     headers={
                         'Cache-Control': 'no-cache',
                         'X-Accel-Buffering': 'no',
@@ -220,7 +277,9 @@ def proxy_messages():
                 )
             
             # Non-streaming: convert response
-            openai_response = response.json()
+            await response.aread()
+            await response.aclose()
+            openai_response = orjson.loads(response.content)
             anthropic_response = convert_openai_to_anthropic(openai_response)
             
             # Log and save
@@ -229,90 +288,99 @@ def proxy_messages():
                     "request_id": request_id,
                     "backend": "grok",
                     "original_model": original_model,
-                    "duration_ms": (datetime.now() - start_time).total_seconds() * 1000
+                    "duration_ms": (time.perf_counter_ns() - start_perf_ns) / 1e6
                 }
-                save_request_response_logs(request_id, original_request, anthropic_response, metadata)
+                save_request_response_logs(request_id, original_request, anthropic_response, metadata, started)
             
             return Response(
-                json.dumps(anthropic_response),
-                content_type='application/json',
-                status=200
+                orjson.dumps(anthropic_response),
+                media_type='application/json',
+                status_code=200
             )
             
         except Exception as e:
-            logging.error(f"Error processing Grok request: {str(e)}")
+            logging.error("Error processing Grok request: %s", e)
             return Response(
-                json.dumps({"error": f"Proxy error: {str(e)}"}),
-                status=500,
-                content_type='application/json'
+                orjson.dumps({"error": f"Proxy error: {str(e)}"}),
+                status_code=500,
+                media_type='application/json'
             )
     
     else:  # BACKEND == 'anthropic'
         # For Anthropic, just forward with potential prompt modification
         try:
-            headers = {
-                'x-api-key': ANTHROPIC_API_KEY,
-                'anthropic-version': request.headers.get('anthropic-version', '2023-06-01'),
-                'Content-Type': 'application/json'
-            }
+            headers = {**ANTHROPIC_HEADERS, 'anthropic-version': request.headers.get('anthropic-version', '2023-06-01')}
             
             # Add any additional headers from the original request
-            for header in ['anthropic-beta', 'anthropic-dangerous-direct-browser-access']:
+            for header in ANTHROPIC_FORWARDED_HEADERS:
                 if header in request.headers:
                     headers[header] = request.headers[header]
             
             stream = data.get('stream', False)
-            response = requests.post(
-                f'{ANTHROPIC_BASE_URL}/messages',
-                json=data,
-                headers=headers,
-                stream=stream
+            if stream:
+                # Successful streams are relayed undecoded, so only ask for encodings the client
+                # accepts; error bodies are decoded here, so only ones httpx can decode as well
+                headers['Accept-Encoding'] = _upstream_accept_encoding(request.headers.get('accept-encoding'))
+            
+            upstream_request = client.build_request(
+                'POST',
+                ANTHROPIC_URL,
+                content=orjson.dumps(data),
+                headers=headers
             )
+            response = await client.send(upstream_request, stream=True)
             
-            logging.info(f"Anthropic Response Status: {response.status_code}")
+            logging.debug("Anthropic Response Status: %d", response.status_code)
             
             if response.status_code != 200:
-                logging.error(f"Anthropic Error: {response.text}")
+                await response.aread()
+                logging.error("Anthropic Error: %s", response.text)
             
-            # For streaming, pass through directly
-            if stream:
-                def generate():
-                    for chunk in response.iter_content(chunk_size=1024):
-                        if chunk:
+            # For streaming, pass the raw (possibly still compressed) bytes through directly
+            if stream and response.status_code == 200:
+                async def generate():
+                    try:
+                        async for chunk in response.aiter_raw():
                             yield chunk
+                    finally:
+                        await response.aclose()
                 
-                return Response(
+                content_encoding = response.headers.get('Content-Encoding')
+                return StreamingResponse(
                     generate(),
-                    content_type=response.headers.get('Content-Type'),
-                    status=response.status_code
+                    media_type=response.headers.get('Content-Type'),
+                    status_code=response.status_code,
+                    headers={'Content-Encoding': content_encoding} if content_encoding else None
                 )
             
-            # Non-streaming
-            response_data = response.json() if response.status_code == 200 else None
+            # Non-streaming: the body is passed through untouched and logged as raw bytes, never parsed
+            await response.aread()
+            await response.aclose()
             
             # Log and save
-            if ENABLE_FULL_LOGGING and response_data:
+            if ENABLE_FULL_LOGGING and response.status_code == 200:
                 metadata = {
                     "request_id": request_id,
                     "backend": "anthropic",
                     "model": data.get('model'),
-                    "duration_ms": (datetime.now() - start_time).total_seconds() * 1000
+                    "duration_ms": (time.perf_counter_ns() - start_perf_ns) / 1e6
                 }
-                save_request_response_logs(request_id, original_request, response_data, metadata)
+                save_request_response_logs(request_id, original_request, response.content, metadata, started)
             
             return Response(
                 response.content,
-                content_type=response.headers.get('Content-Type'),
-                status=response.status_code
+                media_type=response.headers.get('Content-Type'),
+                status_code=response.status_code
             )
             
         except Exception as e:
-            logging.error(f"Error processing Anthropic request: {str(e)}")
+            logging.error("Error processing Anthropic request: %s", e)
             return Response(
-                json.dumps({"error": f"Proxy error: {str(e)}"}),
-                status=500,
-                content_type='application/json'
+                orjson.dumps({"error": f"Proxy error: {str(e)}"}),
+                status_code=500,
+                media_type='application/json'
             )
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8000, debug=True)
\ No newline at end of file
+    # Each worker is a separate process with its own event loop and upstream connection pool
+    uvicorn.run('unified_proxy:app', host='0.0.0.0', port=8000, workers=WORKERS)
\ No newline at end of file